@@ -5,8 +5,7 @@ from abc import ABC, abstractmethod
 
 import numpy as np
 import scipy.stats as ss
-from itertools import islice
-from numpy.linalg import inv
+from scipy.special import gammaln, logsumexp
 from functools import partial
 
 
@@ -35,6 +34,102 @@ class BaseLikelihood(ABC):
             "Update theta is not defined. Please define in separate class to override this function."
         )
 
+    def logpdf(self, data: np.array):
+        """
+        Returns the log probability of the observed data under every run length hypothesis.
+        Defaults to the log of `pdf`, override it when a closed form is available.
+        """
+        return np.log(self.pdf(data))
+
+    def prune(self, keep: np.array):
+        """
+        Keeps only the run length hypotheses selected by `keep` (sorted integer indices).
+        Required by truncated_online_changepoint_detection to bound the memory.
+        """
+        raise NotImplementedError(
+            "Prune is not defined. Please define in separate class to override this function."
+        )
+
+
+class RunLengthBuffer:
+    """
+    Preallocated storage for the parameters of every run length hypothesis.
+
+    The hypotheses occupy the tail of each buffer in increasing run length order, so
+    a bayesian update can be written in place on the active views and the prior of the
+    new run length 0 is written in the free slot just before them. Nothing is shifted
+    or concatenated, and the capacity doubles only when the free slots run out.
+    With a run length cap (see truncated_online_changepoint_detection) the capacity
+    stays bounded by the cap.
+    """
+
+    def __init__(self, capacity: int = None, **priors):
+        """
+        :param capacity: The initial number of hypotheses that fit in the buffers
+        :param priors: The prior value of each named parameter
+        """
+        capacity = max(capacity or 64, 1)
+        self.priors = {name: np.asarray(value) for name, value in priors.items()}
+        self.buffers = {
+            name: np.empty((capacity,) + value.shape, dtype=value.dtype)
+            for name, value in self.priors.items()
+        }
+        self.start = capacity - 1
+        for name, value in self.priors.items():
+            self.buffers[name][self.start] = value
+
+    def __getitem__(self, name):
+        """The active parameters of every hypothesis, as a view."""
+        return self.buffers[name][self.start :]
+
+    def __len__(self):
+        return self.capacity - self.start
+
+    @property
+    def capacity(self):
+        return len(next(iter(self.buffers.values())))
+
+    def push_prior(self):
+        """Prepends the prior parameters as the new run length 0 hypothesis."""
+        if self.start == 0:
+            self.reserve(2 * self.capacity)
+        self.start -= 1
+        for name, value in self.priors.items():
+            self.buffers[name][self.start] = value
+
+    def reserve(self, capacity: int):
+        """Grows the buffers so that `capacity` hypotheses fit."""
+        if capacity <= self.capacity:
+            return
+        size = len(self)
+        for name, buffer in self.buffers.items():
+            grown = np.empty((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+            grown[capacity - size :] = buffer[self.start :]
+            self.buffers[name] = grown
+        self.start = capacity - size
+
+    @classmethod
+    def from_arrays(cls, priors: dict, params: dict, capacity: int = None):
+        """
+        Rebuilds a buffer holding the hypotheses `params`, e.g. from a checkpoint.
+        :param priors: The prior value of each named parameter
+        :param params: The active parameters of every hypothesis, by name
+        :param capacity: The number of hypotheses that fit in the buffers
+        """
+        size = len(next(iter(params.values())))
+        buffer = cls(max(capacity or 0, size), **priors)
+        buffer.start = buffer.capacity - size
+        for name, value in params.items():
+            buffer.buffers[name][buffer.start :] = value
+        return buffer
+
+    def prune(self, keep: np.array):
+        """Keeps only the hypotheses at the sorted indices `keep`, compacted at the tail."""
+        start = self.capacity - len(keep)
+        for name, buffer in self.buffers.items():
+            buffer[start:] = buffer[self.start :][keep]
+        self.start = start
+
 
 class MultivariateT(BaseLikelihood):
     def __init__(
@@ -44,6 +139,8 @@ class MultivariateT(BaseLikelihood):
         kappa: int = 1,
         mu: float = -1,
         scale: float = -1,
+        capacity: int = None,
+        dtype=np.float64,
     ):
         """
         Create a new predictor using the multivariate student T distribution as the posterior predictive.
@@ -55,6 +152,8 @@ class MultivariateT(BaseLikelihood):
         :param mu: The mean of the prior distribution on the mean
         :param scale: The mean of the prior distribution on the precision
         :param dims: The number of variables
+        :param capacity: The number of run length hypotheses to preallocate, e.g. the series length + 1
+        :param dtype: The floating point type of the parameters and of the densities, e.g. np.float32
         """
         # We default to the minimum possible degrees of freedom, which is 1 greater than the dimensionality
         if dof == 0:
@@ -77,11 +176,38 @@ class MultivariateT(BaseLikelihood):
         # The dimensionality of the dataset (number of variables)
         self.dims = dims
 
+        self.dtype = np.dtype(dtype)
+
         # Each parameter is a vector of size 1 x t, where t is time. Therefore each vector grows with each update.
-        self.dof = np.array([dof])
-        self.kappa = np.array([kappa])
-        self.mu = np.array([mu])
-        self.scale = np.array([scale])
+        # The scale is kept as its lower Cholesky factor, so it can be updated in O(D^2) per hypothesis
+        self.params = RunLengthBuffer(
+            capacity,
+            dof=np.asarray(dof, dtype=dtype),
+            kappa=np.asarray(kappa, dtype=dtype),
+            mu=np.asarray(mu, dtype=dtype),
+            chol=np.linalg.cholesky(scale).astype(dtype),
+        )
+
+    @property
+    def dof(self):
+        return self.params["dof"]
+
+    @property
+    def kappa(self):
+        return self.params["kappa"]
+
+    @property
+    def mu(self):
+        return self.params["mu"]
+
+    @property
+    def chol(self):
+        return self.params["chol"]
+
+    @property
+    def scale(self):
+        """The prior and posterior precision scale matrices, rebuilt from their Cholesky factors."""
+        return self.chol @ np.swapaxes(self.chol, 1, 2)
 
     def pdf(self, data: np.array):
         """
@@ -89,21 +215,39 @@ class MultivariateT(BaseLikelihood):
         Parmeters:
             data - the datapoints to be evaualted (shape: 1 x D vector)
         """
+        return np.exp(self.logpdf(data))
+
+    def logpdf(self, data: np.array):
+        """
+        Returns the log probability of the observed data under the current and historical parameters.
+        Every run length hypothesis is evaluated at once with the closed form of the multivariate
+        student T log density, using batched Cholesky factors of the precision.
+        Parmeters:
+            data - the datapoints to be evaualted (shape: 1 x D vector)
+        """
         self.t += 1
+        data = np.asarray(data, dtype=self.dtype)
         t_dof = self.dof - self.dims + 1
-        expanded = np.expand_dims((self.kappa * t_dof) / (self.kappa + 1), (1, 2))
-        ret = np.empty(self.t)
-        try:
-            # This can't be vectorised due to https://github.com/scipy/scipy/issues/13450
-            for i, (df, loc, shape) in islice(
-                enumerate(zip(t_dof, self.mu, inv(expanded * self.scale))), self.t
-            ):
-                ret[i] = ss.multivariate_t.pdf(x=data, df=df, loc=loc, shape=shape)
-        except AttributeError:
-            raise Exception(
-                "You need scipy 1.6.0 or greater to use the multivariate t distribution"
-            )
-        return ret
+        # The shape matrix of the predictive is inv(expanded * scale), so its inverse is
+        # available without any inversion
+        expanded = (self.kappa * t_dof) / (self.kappa + 1)
+        chol = self.chol
+
+        # Mahalanobis distance (x - mu)^T (expanded * scale) (x - mu) = expanded * |L^T (x - mu)|^2
+        z = np.einsum("nji,nj->ni", chol, data - self.mu)
+        maha = expanded * np.einsum("ni,ni->n", z, z)
+        # log|inv(shape)| = D log(expanded) + log|scale|
+        log_det = self.dims * np.log(expanded) + 2 * np.log(
+            np.diagonal(chol, axis1=1, axis2=2)
+        ).sum(axis=1)
+
+        return (
+            gammaln((t_dof + self.dims) / 2)
+            - gammaln(t_dof / 2)
+            - self.dims / 2 * np.log(t_dof * np.pi)
+            + log_det / 2
+            - (t_dof + self.dims) / 2 * np.log1p(maha / t_dof)
+        )
 
     def update_theta(self, data: np.array, **kwargs):
         """
@@ -111,30 +255,165 @@ class MultivariateT(BaseLikelihood):
         Parmeters:
             data - the datapoints to be evaluated (shape: 1 x D vector)
         """
+        data = np.asarray(data, dtype=self.dtype)
         centered = data - self.mu
 
         # We simultaneously update each parameter in the vector, because following figure 1c of the BOCD paper, each
         # parameter for a given t, r is derived from the same parameter for t-1, r-1
-        # Then, we add the prior back in as the first element
-        self.scale = np.concatenate(
-            [
-                self.scale[:1],
-                inv(
-                    inv(self.scale)
-                    + np.expand_dims(self.kappa / (self.kappa + 1), (1, 2))
-                    * (np.expand_dims(centered, 2) @ np.expand_dims(centered, 1))
-                ),
-            ]
+        # The updates are written in place, then we add the prior back in as the first element
+        # By Sherman-Morrison, inv(inv(scale) + b * c c^T) = scale - u u^T with
+        # u = scale c * sqrt(b / (1 + b * c^T scale c)), a rank-one downdate of the Cholesky factor.
+        beta = self.kappa / (self.kappa + 1)
+        lt_centered = np.einsum("nji,nj->ni", self.chol, centered)
+        scale_centered = np.einsum("nij,nj->ni", self.chol, lt_centered)
+        quad = np.einsum("ni,ni->n", lt_centered, lt_centered)
+        u = scale_centered * np.expand_dims(np.sqrt(beta / (1 + beta * quad)), 1)
+        cholesky_downdate(self.chol, u)
+
+        self.mu[:] = (np.expand_dims(self.kappa, 1) * self.mu + data) / np.expand_dims(
+            self.kappa + 1, 1
         )
-        self.mu = np.concatenate(
-            [
-                self.mu[:1],
-                (np.expand_dims(self.kappa, 1) * self.mu + data)
-                / np.expand_dims(self.kappa + 1, 1),
-            ]
+        self.dof[:] += 1
+        self.kappa[:] += 1
+        self.params.push_prior()
+
+    def prune(self, keep: np.array):
+        """
+        Drops the parameters of the run length hypotheses that are not in `keep`
+        Parmeters:
+            keep - sorted indices of the hypotheses to keep, 0 (the prior) must be included
+        """
+        self.params.prune(keep)
+
+
+class DiagonalT(BaseLikelihood):
+    def __init__(
+        self,
+        dims: int = 1,
+        alpha: float = 1,
+        beta: float = 0.5,
+        kappa: float = 1,
+        mu: float = 0,
+        capacity: int = None,
+        dtype=np.float64,
+    ):
+        """
+        Create a new predictor that treats every variable as independent, each with a
+        Normal-Gamma prior and therefore a univariate student T posterior predictive.
+            Everything is vectorized over the variables and the run lengths, so a step costs
+            O(T * D) instead of the O(T * D^2) of MultivariateT. With the default prior and
+            dims=1 it matches MultivariateT(dims=1).
+        :param dims: The number of variables
+        :param alpha: The shape of the Gamma prior on the precision
+        :param beta: The rate of the Gamma prior on the precision
+        :param kappa: The number of observations we've already seen
+        :param mu: The mean of the prior distribution on the mean
+        :param capacity: The number of run length hypotheses to preallocate, e.g. the series length + 1
+        :param dtype: The floating point type of the parameters and of the densities, e.g. np.float32
+        """
+        # Track time
+        self.t = 0
+
+        # The dimensionality of the dataset (number of variables)
+        self.dims = dims
+
+        self.dtype = np.dtype(dtype)
+
+        self.params = RunLengthBuffer(
+            capacity,
+            alpha=np.asarray(alpha, dtype=dtype),
+            beta=np.full(dims, beta, dtype=dtype),
+            kappa=np.asarray(kappa, dtype=dtype),
+            mu=np.full(dims, mu, dtype=dtype),
+        )
+
+    @property
+    def alpha(self):
+        return self.params["alpha"]
+
+    @property
+    def beta(self):
+        return self.params["beta"]
+
+    @property
+    def kappa(self):
+        return self.params["kappa"]
+
+    @property
+    def mu(self):
+        return self.params["mu"]
+
+    def pdf(self, data: np.array):
+        """
+        Returns the probability of the observed data under the current and historical parameters
+        Parmeters:
+            data - the datapoints to be evaualted (shape: 1 x D vector)
+        """
+        return np.exp(self.logpdf(data))
+
+    def logpdf(self, data: np.array):
+        """
+        Returns the log probability of the observed data under the current and historical parameters,
+        the sum of the independent student T log densities of every variable.
+        Parmeters:
+            data - the datapoints to be evaualted (shape: 1 x D vector)
+        """
+        self.t += 1
+        data = np.asarray(data, dtype=self.dtype)
+        df = np.expand_dims(2 * self.alpha, 1)
+        scale_sq = self.beta * np.expand_dims((self.kappa + 1) / (self.alpha * self.kappa), 1)
+        log_density = (
+            gammaln((df + 1) / 2)
+            - gammaln(df / 2)
+            - np.log(df * np.pi * scale_sq) / 2
+            - (df + 1) / 2 * np.log1p((data - self.mu) ** 2 / (df * scale_sq))
         )
-        self.dof = np.concatenate([self.dof[:1], self.dof + 1])
-        self.kappa = np.concatenate([self.kappa[:1], self.kappa + 1])
+        return log_density.sum(axis=1)
+
+    def update_theta(self, data: np.array, **kwargs):
+        """
+        Performs a bayesian update on the prior parameters, given data
+        Parmeters:
+            data - the datapoints to be evaluated (shape: 1 x D vector)
+        """
+        data = np.asarray(data, dtype=self.dtype)
+        kappa = np.expand_dims(self.kappa, 1)
+        self.beta[:] += kappa * (data - self.mu) ** 2 / (2 * (kappa + 1))
+        self.mu[:] = (kappa * self.mu + data) / (kappa + 1)
+        self.alpha[:] += 0.5
+        self.kappa[:] += 1
+        self.params.push_prior()
+
+    def prune(self, keep: np.array):
+        """
+        Drops the parameters of the run length hypotheses that are not in `keep`
+        Parmeters:
+            keep - sorted indices of the hypotheses to keep, 0 (the prior) must be included
+        """
+        self.params.prune(keep)
+
+
+# The likelihoods StreamingBOCPD.load can restore, by class name
+LIKELIHOODS = {"MultivariateT": MultivariateT, "DiagonalT": DiagonalT}
+
+
+def cholesky_downdate(chol: np.array, x: np.array):
+    """
+    Rank-one downdate of a stack of Cholesky factors, in place.
+    Returns L' such that L' L'^T = L L^T - x x^T for every matrix of the stack, in O(D^2) per matrix.
+    Parameters:
+        chol - lower triangular factors (shape: n x D x D), overwritten
+        x - the downdate vectors (shape: n x D), overwritten
+    """
+    for k in range(chol.shape[1]):
+        diag = chol[:, k, k]
+        r = np.sqrt(np.maximum(diag**2 - x[:, k] ** 2, np.finfo(chol.dtype).tiny))
+        c = np.expand_dims(r / diag, 1)
+        s = np.expand_dims(x[:, k] / diag, 1)
+        chol[:, k, k] = r
+        chol[:, k + 1 :, k] = (chol[:, k + 1 :, k] - s * x[:, k + 1 :]) / c
+        x[:, k + 1 :] = c * x[:, k + 1 :] - s * chol[:, k + 1 :, k]
+    return chol
 
 
 def const_prior(t, p: float = 0.25):
@@ -224,4 +503,303 @@ def online_changepoint_detection(data, hazard_function, log_likelihood_class):
 
         maxes[t] = R[:, t].argmax()
 
-    return R, maxes
\ No newline at end of file
+    return R, maxes
+
+
+class StreamingBOCPD:
+    """
+    Stateful bayesian online changepoint detection that consumes the observations as they arrive.
+
+    The run length distribution is kept in log space and truncated like in
+    truncated_online_changepoint_detection, so with `max_run_length` set the state
+    (the distribution and the likelihood parameters) stays O(max_run_length) no
+    matter how many observations were seen.
+    """
+
+    def __init__(
+        self,
+        hazard_function,
+        log_likelihood_class,
+        max_run_length: int = None,
+        prune_threshold: float = 0,
+        cp_delay: int = 10,
+    ):
+        """
+        :param hazard_function: The hazard function, evaluated on the run lengths
+        :param log_likelihood_class: The likelihood, it must implement `prune`
+        :param max_run_length: The maximum number of run length hypotheses kept per step
+        :param prune_threshold: Hypotheses whose probability falls below this are dropped.
+            Default is 0 (none): a fixed threshold drops the hypotheses of a new run before
+            the evidence for it builds up, the cap alone bounds the memory
+        :param cp_delay: The run length tracked by `cp_prob`
+        """
+        self.hazard_function = hazard_function
+        self.log_likelihood_class = log_likelihood_class
+        self.max_run_length = max_run_length
+        self.prune_threshold = prune_threshold
+        self.cp_delay = cp_delay
+
+        # Number of observations seen so far
+        self.t = 0
+        # log R[:, t] restricted to the kept run lengths, in the floating point type of the likelihood
+        self.log_R = np.zeros(1, dtype=getattr(log_likelihood_class, "dtype", np.float64))
+        self.run_lengths = np.zeros(1, dtype=int)
+
+    @property
+    def map_run_length(self):
+        """The most probable current run length."""
+        return self.run_lengths[self.log_R.argmax()]
+
+    @property
+    def cp_prob(self):
+        """The probability that the current run started `cp_delay` steps ago."""
+        return np.exp(self.log_R[self.run_lengths == self.cp_delay]).sum()
+
+    def step(self, x: np.array):
+        """
+        Consumes one observation.
+        Parameters:
+            x - the datapoint (shape: 1 x D vector)
+        Returns:
+            the MAP run length and the change probability after observing x
+        """
+        log_likelihood_class = self.log_likelihood_class
+
+        # Evaluate the predictive distribution for the new datum under each of
+        # the kept parameters.
+        log_predprobs = log_likelihood_class.logpdf(x)
+
+        # Evaluate the hazard function for the kept run lengths
+        H = np.asarray(self.hazard_function(self.run_lengths), dtype=self.log_R.dtype)
+
+        # Growth probabilities are shifted one run length up, the changepoint
+        # probability accumulates at r = 0, then renormalize.
+        log_joint = self.log_R + log_predprobs
+        log_R = np.concatenate(
+            [[logsumexp(log_joint + np.log(H))], log_joint + np.log1p(-H)]
+        )
+        log_R -= logsumexp(log_R)
+        run_lengths = np.concatenate([[0], self.run_lengths + 1])
+
+        # Update the parameter sets for each kept run length.
+        log_likelihood_class.update_theta(x, t=self.t)
+        self.t += 1
+
+        # Drop negligible hypotheses, then cap the number of survivors.
+        # The prior (r = 0) is always kept.
+        log_threshold = np.log(self.prune_threshold) if self.prune_threshold > 0 else -np.inf
+        keep = log_R >= log_threshold
+        keep[0] = True
+        if self.max_run_length is not None and keep.sum() > self.max_run_length:
+            candidates = np.where(keep, log_R, -np.inf)
+            candidates[0] = np.inf
+            keep = np.zeros_like(keep)
+            keep[np.argpartition(-candidates, self.max_run_length - 1)[: self.max_run_length]] = True
+        if not keep.all():
+            keep = np.flatnonzero(keep)
+            log_R = log_R[keep]
+            log_R -= logsumexp(log_R)
+            run_lengths = run_lengths[keep]
+            log_likelihood_class.prune(keep)
+
+        self.log_R = log_R
+        self.run_lengths = run_lengths
+        return self.map_run_length, self.cp_prob
+
+    def save(self, path):
+        """
+        Saves the detector state (run length distribution and likelihood parameters) to an .npz file.
+        The likelihood must store its parameters in a RunLengthBuffer, like MultivariateT and DiagonalT.
+        Parameters:
+            path - the checkpoint file
+        """
+        likelihood = self.log_likelihood_class
+        np.savez(
+            path,
+            t=self.t,
+            log_R=self.log_R,
+            run_lengths=self.run_lengths,
+            max_run_length=-1 if self.max_run_length is None else self.max_run_length,
+            prune_threshold=self.prune_threshold,
+            cp_delay=self.cp_delay,
+            likelihood=type(likelihood).__name__,
+            likelihood_t=likelihood.t,
+            dims=likelihood.dims,
+            **{f"prior_{name}": value for name, value in likelihood.params.priors.items()},
+            **{f"param_{name}": likelihood.params[name] for name in likelihood.params.priors},
+        )
+
+    @classmethod
+    def load(cls, path, hazard_function, capacity: int = None):
+        """
+        Restores a detector saved with `save`, ready to consume the observations after the last one it saw.
+        Parameters:
+            path - the checkpoint file
+            hazard_function - the hazard function, it is not part of the checkpoint
+            capacity - the number of hypotheses to preallocate in the likelihood
+        """
+        with np.load(path) as checkpoint:
+            # the parameters come from the checkpoint, so __init__ is skipped
+            likelihood_class = LIKELIHOODS[str(checkpoint["likelihood"])]
+            likelihood = likelihood_class.__new__(likelihood_class)
+            likelihood.t = int(checkpoint["likelihood_t"])
+            likelihood.dims = int(checkpoint["dims"])
+            likelihood.dtype = checkpoint["param_mu"].dtype
+            likelihood.params = RunLengthBuffer.from_arrays(
+                {k[len("prior_") :]: checkpoint[k] for k in checkpoint.files if k.startswith("prior_")},
+                {k[len("param_") :]: checkpoint[k] for k in checkpoint.files if k.startswith("param_")},
+                capacity,
+            )
+
+            max_run_length = int(checkpoint["max_run_length"])
+            detector = cls(
+                hazard_function,
+                likelihood,
+                max_run_length=None if max_run_length < 0 else max_run_length,
+                prune_threshold=float(checkpoint["prune_threshold"]),
+                cp_delay=int(checkpoint["cp_delay"]),
+            )
+            detector.t = int(checkpoint["t"])
+            detector.log_R = checkpoint["log_R"]
+            detector.run_lengths = checkpoint["run_lengths"]
+        return detector
+
+    def update(self, data: np.array):
+        """
+        Consumes one observation, or a small batch of them.
+        Parameters:
+            data - a datapoint (shape: 1 x D vector) or a batch (shape: n x D)
+        Returns:
+            the MAP run length and the change probability after each observation
+        """
+        data = np.asarray(data)
+        if data.ndim < 2:
+            return self.step(data)
+        maxes = np.empty(len(data), dtype=int)
+        cp_probs = np.empty(len(data))
+        for i, x in enumerate(data):
+            maxes[i], cp_probs[i] = self.step(x)
+        return maxes, cp_probs
+
+
+def truncated_online_changepoint_detection(
+    data,
+    hazard_function,
+    log_likelihood_class,
+    max_run_length: int = None,
+    prune_threshold: float = 0,
+    cp_delay: int = 10,
+):
+    """
+    Log-space variant of online_changepoint_detection that never materializes R.
+    Only a bounded vector of run length hypotheses is kept: the ones with a posterior
+    probability below `prune_threshold` are dropped, and at most `max_run_length`
+    of the most probable ones survive each step. Memory is O(max_run_length) instead
+    of O(T^2). Without truncation (max_run_length=None, the default prune_threshold=0)
+    the output matches online_changepoint_detection.
+
+    Parameters:
+    data    -- the time series data
+    hazard_function -- the hazard function, evaluated on the run lengths
+    log_likelihood_class -- the likelihood, it must implement `prune`
+    max_run_length -- the maximum number of run length hypotheses kept per step
+    prune_threshold -- hypotheses whose probability falls below this are dropped, none by default
+    cp_delay -- the run length tracked by `cp_probs`
+
+    Outputs:
+        cp_probs -- the probability at each time step that the run started `cp_delay` steps ago,
+                    i.e. the row R[cp_delay, :] of online_changepoint_detection
+        maxes -- the argmax on column axis of matrix R (growth probability value) for each time step
+    """
+    maxes = np.zeros(len(data) + 1)
+    cp_probs = np.zeros(len(data) + 1)
+
+    detector = StreamingBOCPD(
+        hazard_function,
+        log_likelihood_class,
+        max_run_length=max_run_length,
+        prune_threshold=prune_threshold,
+        cp_delay=cp_delay,
+    )
+    for t, x in enumerate(data):
+        maxes[t] = detector.map_run_length
+        cp_probs[t] = detector.cp_prob
+        detector.step(x)
+
+    return cp_probs, maxes
+
+
+def first_changepoint(data, hazard_function, log_likelihood_class, lookahead: int = 0, **kwargs):
+    """
+    Runs BOCPD online and stops as soon as the first changepoint is confirmed.
+    A changepoint is a jump of more than 1 in the MAP run length, like in find_cps.
+    It is confirmed once the next `lookahead` steps show no further jump; a jump
+    inside the lookahead replaces the candidate. With lookahead=0 (and no truncation)
+    the result is the first changepoint find_cps reports on the maxes of
+    online_changepoint_detection, without processing the rest of the data.
+
+    Parameters:
+    data    -- the time series data
+    hazard_function -- the hazard function, evaluated on the run lengths
+    log_likelihood_class -- the likelihood
+    lookahead -- the number of steps a changepoint must hold to be confirmed
+    kwargs -- the truncation options of StreamingBOCPD
+
+    Outputs:
+        cp -- the index of the first changepoint, or None if there is none
+    """
+    detector = StreamingBOCPD(hazard_function, log_likelihood_class, **kwargs)
+    previous, candidate = 0, None
+    for t, x in enumerate(data):
+        current, _ = detector.step(x)
+        if abs(current - previous) > 1:
+            candidate = t + 1
+        if candidate is not None and t + 1 - candidate >= lookahead:
+            return candidate
+        previous = current
+    # the data ended before the lookahead did
+    return candidate
+
+
+def hazard_sweep(data, hazard_functions, log_likelihood_class):
+    """
+    Runs online_changepoint_detection for several hazard functions at once.
+    The predictive probabilities do not depend on the hazard, so they are computed
+    once per step and only the cheap run length recursion is repeated, vectorized
+    over the hazard functions. Memory is O(len(hazard_functions) * T).
+
+    Parameters:
+    data    -- the time series data
+    hazard_functions -- the hazard functions to evaluate, e.g. [partial(constant_hazard, lam) for lam in lams]
+    log_likelihood_class -- the likelihood
+
+    Outputs:
+        maxes -- for each hazard function (row), the maxes of online_changepoint_detection
+    """
+    maxes = np.zeros((len(hazard_functions), len(data) + 1))
+
+    # log R[:, t] for every hazard function
+    log_R = np.zeros((len(hazard_functions), 1))
+
+    for t, x in enumerate(data):
+        maxes[:, t] = log_R.argmax(axis=1)
+
+        # Shared by every hazard function
+        log_predprobs = log_likelihood_class.logpdf(x)
+
+        run_lengths = np.arange(t + 1)
+        H = np.array([hazard_function(run_lengths) for hazard_function in hazard_functions])
+
+        log_joint = log_R + log_predprobs
+        log_R = np.concatenate(
+            [
+                logsumexp(log_joint + np.log(H), axis=1, keepdims=True),
+                log_joint + np.log1p(-H),
+            ],
+            axis=1,
+        )
+        log_R -= logsumexp(log_R, axis=1, keepdims=True)
+
+        log_likelihood_class.update_theta(x, t=t)
+
+    return maxes
@@ -2,9 +2,9 @@ import warnings
 warnings.filterwarnings("ignore")
 import pandas 
 import numpy as np
-from baro.utility import drop_constant, find_cps
+from baro.utility import MetricSchema, find_cps
 
-def nsigma(data, k=3, startsfrom=100):
+def nsigma(data, k=3, startsfrom=100, return_mask=False):
     """For each time series (column) in the data,
     detect anomalies using the n-sigma rule.
     
@@ -15,23 +15,49 @@ def nsigma(data, k=3, startsfrom=100):
         The number of standard deviations from the mean to consider as an anomaly. Default is 3.
     - startsfrom : int, optional
         The index from which to start calculating mean and standard deviation. Default is 100.
+    - return_mask : bool, optional
+        Whether to also return which column is anomalous at which timestep. Default is False.
         
     Returns:
     - anomalies : list
         List of timestamps where anomalies were detected.
+    - mask : pandas DataFrame
+        Only if `return_mask` is True, the boolean anomaly mask of every column.
     """
-    anomalies = []
-    for col in data.columns:
-        if col == "time":
-            continue
-        # for each timestep starts from `startsfrom`,
-        # calculate the mean and standard deviation
-        # of the all past timesteps
-        for i in range(startsfrom, len(data)):
-            mean = data[col].iloc[:i].mean()
-            std = data[col].iloc[:i].std()
-            if abs(data[col].iloc[i] - mean) > k * std:
-                anomalies.append(data['time'].iloc[i])
+    cols = [c for c in data.columns if c != "time"]
+    values = data[cols].to_numpy(dtype=float)
+
+    # for each timestep, the mean and standard deviation of all the past
+    # timesteps, from cumulative sums over all columns at once. NaN are
+    # skipped like pandas does, and the values are centered first so the
+    # sums of squares keep their precision.
+    valid = ~np.isnan(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        center = np.nanmean(values, axis=0)
+    centered = np.where(valid, values - center, 0)
+    zeros = np.zeros((1, len(cols)))
+    count = np.concatenate([zeros, np.cumsum(valid, axis=0)])
+    total = np.concatenate([zeros, np.cumsum(centered, axis=0)])
+    total_sq = np.concatenate([zeros, np.cumsum(centered**2, axis=0)])
+
+    steps = np.arange(startsfrom, len(data))
+    n = count[steps]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total[steps] / n
+        std = np.sqrt(np.maximum(total_sq[steps] - n * mean**2, 0) / (n - 1))
+        std[n < 2] = np.nan
+        is_anomaly = np.abs(centered[steps] - mean) > k * std
+    is_anomaly &= valid[steps]
+
+    # the same order as a column by column scan
+    col_idx, step_idx = np.nonzero(is_anomaly.T)
+    anomalies = data["time"].to_numpy()[steps[step_idx]].tolist()
+
+    if return_mask is True:
+        mask = pandas.DataFrame(False, index=data.index, columns=cols)
+        mask.iloc[steps] = is_anomaly
+        return anomalies, mask
     return anomalies
 
 
@@ -41,8 +67,8 @@ def find_anomalies(data, time_col=None,threshold=0.01):
     Parameters:
     - data : list or numpy array
         The input data to search for anomalies.
-    - time_col : pandas Series, optional
-        The timestamps corresponding to the data. Default is None.
+    - time_col : pandas Series or numpy array, optional
+        The timestamps corresponding to the data. Default is None (the indices).
     - threshold : float, optional
         The threshold value above which a data point is considered an anomaly. Default is 0.01.
         
@@ -52,70 +78,414 @@ def find_anomalies(data, time_col=None,threshold=0.01):
     - anomalies : list
         List of timestamps where anomalies were detected.
     """
-    anomalies = []
-    for i in range(1, len(data)):
-        if data[i] > threshold:
-            # anomalies.append(i)
-            anomalies.append(time_col.iloc[i])
+    data = np.asarray(data)
+    time_col = np.arange(len(data)) if time_col is None else np.asarray(time_col)
+
+    idx = np.flatnonzero(data[1:] > threshold) + 1
 
     # re-try if threshold doesn't work
-    if len(anomalies) == 0:
+    if len(idx) == 0:
         head = 5
-        data = data[head:]
-        # anomalies = [np.argmax(data) + head]
-        anomalies = [time_col.iloc[np.argmax(data) + head]]
+        idx = np.array([np.argmax(data[head:]) + head])
+    anomalies = time_col[idx]
 
     # merge continuous anomalies if the distance are shorter than 5 steps
-    merged_anomalies = [] if len(anomalies) == 0 else [anomalies[0]]
-    for i in range(1, len(anomalies)):
-        if anomalies[i] - anomalies[i-1] > 5:
-            merged_anomalies.append(anomalies[i])
+    keep = np.concatenate([[True], np.diff(anomalies) > 5])
+    merged_anomalies = anomalies[keep]
+    
+    return merged_anomalies.tolist(), anomalies.tolist()
+
+
+def _prepare(data):
+    """Select the latency and error metrics of `data` and min-max normalize them for BOCPD.
+    The metrics are copied once into a 2-D float array, every other step works in place.
+    
+    Parameters:
+    - data : pandas DataFrame
+        The input data containing metrics from microservices.
+        
+    Returns:
+    - data : numpy array
+        The normalized metrics, one column per metric.
+    - columns : list
+        The names of the metrics.
+    """
+    # select latency and error metrics from microservices
+    schema = MetricSchema.of(data.columns)
+    selected = schema.contains("latency", "_error") & ~schema.contains("queue-master", "rabbitmq_")
+    values = data.loc[:, selected].to_numpy(dtype=float, copy=True)
+    columns = data.columns[selected]
+
+    # drop constant columns, a NaN counts as a change like in drop_constant
+    varying = (values != values[0]).any(axis=0)
+    if not varying.all():
+        values, columns = values[:, varying], columns[varying]
+
+    # handle na
+    _ffill(values)
+    values[np.isnan(values)] = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        low = values.min(axis=0)
+        span = values.max(axis=0) - low
+        values -= low
+        values /= span
+    _ffill(values)
+    values[np.isnan(values)] = 0
+        
+    return values, columns.to_list()
+
+
+def _ffill(values):
+    """Forward fill the NaN of every column of the 2-D array `values`, in place."""
+    missing = np.isnan(values)
+    if not missing.any():
+        return
+    # the row of the last valid value at or before each row
+    source = np.where(missing, 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(source, axis=0, out=source)
+    values[:] = np.take_along_axis(values, source, axis=0)
+
+
+def reduce_dimensions(data, n_components, method="pca", fit_length=None, random_state=0):
+    """Project the BOCPD input onto a few components to cut the cost of the detector.
     
-    return merged_anomalies, anomalies
+    Parameters:
+    - data : pandas DataFrame or numpy array
+        A DataFrame is first prepared like in `bocpd` (latency and error metrics, min-max normalized).
+    - n_components : int
+        The number of components to keep.
+    - method : str, optional
+        "pca" or "random" (a gaussian random projection). Default is "pca".
+    - fit_length : int, optional
+        Fit the projection on the leading `fit_length` rows only, e.g. the normal period.
+        Default is None (all rows).
+    - random_state : int, optional
+        The seed of the random projection. Default is 0.
+        
+    Returns:
+    - projected : numpy array
+        The min-max normalized components, one column per component.
+    - explained_variance_ratio : numpy array or None
+        The fraction of the variance of the fitted rows explained by each component,
+        None for the random projection.
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.random_projection import GaussianRandomProjection
+    assert method in ["pca", "random"], f"{method} is not supported!"
+    if isinstance(data, pandas.DataFrame):
+        data, _ = _prepare(data)
+    fit_data = data if fit_length is None else data[:fit_length]
+
+    if method == "pca":
+        n_components = min(n_components, *fit_data.shape)
+        projection = PCA(n_components=n_components).fit(fit_data)
+        explained_variance_ratio = projection.explained_variance_ratio_
+    else:
+        projection = GaussianRandomProjection(
+            n_components=n_components, random_state=random_state
+        ).fit(fit_data)
+        explained_variance_ratio = None
+    projected = projection.transform(data)
+
+    return _minmax(projected), explained_variance_ratio
+
+
+def _minmax(data):
+    """Scale every column of `data` back to the [0, 1] range the BOCPD prior expects, constant columns become 0."""
+    with np.errstate(invalid="ignore"):
+        data = (data - data.min(axis=0)) / np.ptp(data, axis=0)
+    return np.nan_to_num(data)
+
 
+def _likelihood_class(likelihood):
+    """Return the BOCPD likelihood class named by `likelihood`."""
+    from baro._bocpd import MultivariateT, DiagonalT
+    assert likelihood in ["multivariate", "diagonal"], f"{likelihood} is not supported!"
+    return MultivariateT if likelihood == "multivariate" else DiagonalT
 
-def bocpd(data):
+
+def bocpd(
+    data,
+    max_run_length=None,
+    likelihood="multivariate",
+    early_exit=False,
+    lookahead=0,
+    n_components=None,
+    reduction="pca",
+    reduction_fit_length=None,
+    coarse_factor=None,
+    refine_window=100,
+    dtype=np.float64,
+    univariate=False,
+    n_jobs=None,
+    fusion="max",
+):
     """Perform Multivariate Bayesian Online Change Point Detection (BOCPD) on the input data.
     
     Parameters:
     - data : pandas DataFrame
         The input data containing metrics from microservices.
+    - max_run_length : int, optional
+        If set, run the log-space BOCPD that keeps at most `max_run_length` run length
+        hypotheses per step, so memory and time stay bounded on long windows.
+        Default is None (the exact BOCPD).
+    - likelihood : str, optional
+        "multivariate" models the metrics jointly with a full covariance, "diagonal" models
+        them as independent, which scales linearly with the number of metrics.
+        Default is "multivariate".
+    - early_exit : bool, optional
+        If True, stop at the first anomaly and return only it. Default is False.
+    - lookahead : int, optional
+        With `early_exit`, the number of steps the first anomaly must hold before it is
+        returned. Default is 0.
+    - n_components : int, optional
+        If set, project the metrics onto `n_components` components before the detection,
+        see `reduce_dimensions`. Default is None (no projection).
+    - reduction : str, optional
+        The projection, "pca" or "random". Default is "pca".
+    - reduction_fit_length : int, optional
+        Fit the projection on the leading `reduction_fit_length` rows only. Default is None (all rows).
+    - coarse_factor : int, optional
+        If set, first detect on averages of `coarse_factor` consecutive rows, then re-run the
+        detection at full resolution only around each coarse change point, which is reported
+        at the start of the new run. Default is None.
+    - refine_window : int, optional
+        The number of rows on each side of a coarse change point that are re-analyzed.
+        Default is 100.
+    - dtype : numpy dtype, optional
+        The floating point type of the detector. np.float32 halves its memory, it always runs
+        the log-space BOCPD (with `max_run_length` if set). Default is np.float64.
+    - univariate : bool, optional
+        If True, run an independent univariate BOCPD on every metric in parallel and fuse
+        their change points, see `univariate_bocpd`. It cannot be combined with `likelihood`,
+        `dtype`, `early_exit`, `lookahead`, `n_components` or `coarse_factor`. Default is False.
+    - n_jobs : int, optional
+        With `univariate`, the number of worker processes. Default is None (all cores).
+    - fusion : str, optional
+        With `univariate`, "max" or "count", see `univariate_bocpd`. Default is "max".
         
     Returns:
     - anomalies : list
         List of timestamps where anomalies were detected.
     """
     from functools import partial
-    from baro._bocpd import online_changepoint_detection, constant_hazard, MultivariateT
-    data = data.copy()
+    from baro._bocpd import (
+        online_changepoint_detection,
+        truncated_online_changepoint_detection,
+        first_changepoint,
+        constant_hazard,
+    )
+    if univariate is True:
+        # the univariate detector has its own likelihood and float64 engine
+        combined = [
+            name
+            for name, unsupported in [
+                ("likelihood", likelihood != "multivariate"),
+                ("dtype", np.dtype(dtype) != np.float64),
+                ("early_exit", early_exit is not False),
+                ("lookahead", lookahead != 0),
+                ("n_components", n_components is not None),
+                ("coarse_factor", coarse_factor is not None),
+            ]
+            if unsupported
+        ]
+        assert len(combined) == 0, f"{', '.join(combined)} cannot be combined with univariate!"
+        return univariate_bocpd(
+            data, n_jobs=n_jobs, fusion=fusion, max_run_length=max_run_length
+        )["anomalies"]
+
+    likelihood_class = partial(_likelihood_class(likelihood), dtype=dtype)
+    data, _ = _prepare(data)
+    if n_components is not None:
+        data, _ = reduce_dimensions(
+            data, n_components, method=reduction, fit_length=reduction_fit_length
+        )
+
+    if early_exit is True:
+        cp = first_changepoint(
+            data,
+            partial(constant_hazard, 50),
+            likelihood_class(dims=data.shape[1], capacity=(max_run_length or len(data)) + 1),
+            lookahead=lookahead,
+            max_run_length=max_run_length,
+        )
+        return [] if cp is None else [cp]
+
+    def detect(data):
+        """Return the maxes of the detector on `data`."""
+        if max_run_length is None and np.dtype(dtype) == np.float64:
+            R, maxes = online_changepoint_detection(
+                data,
+                partial(constant_hazard, 50),
+                likelihood_class(dims=data.shape[1], capacity=len(data) + 1)
+            )
+        else:
+            _, maxes = truncated_online_changepoint_detection(
+                data,
+                partial(constant_hazard, 50),
+                likelihood_class(dims=data.shape[1], capacity=(max_run_length or len(data)) + 1),
+                max_run_length=max_run_length,
+            )
+        return maxes
+
+    if coarse_factor is not None:
+        return _coarse_to_fine(data, detect, coarse_factor, refine_window)
+
+    maxes = detect(data)
+    cps = find_cps(maxes)
+    anomalies = [p[0] for p in cps]
+    # anomalies, merged_anomalies = find_anomalies(data=R[Nw,Nw:-1].tolist(), time_col=time_col)
     
-    # select latency and error metrics from microservices
-    selected_cols = []
-    for c in data.columns:
-        if 'queue-master' in c or 'rabbitmq_' in c: continue
-        if "latency" in c or "latency-50" in c or "_error" in c:
-            selected_cols.append(c)
-    data = data[selected_cols]
+    return anomalies
 
-    # handle na
-    data = drop_constant(data)
-    data = data.fillna(method="ffill")
-    data = data.fillna(0)
-    for c in data.columns:
-        data[c] = (data[c] - np.min(data[c])) / (np.max(data[c]) - np.min(data[c]))
-    data = data.fillna(method="ffill")
-    data = data.fillna(0)
+
+def _run_starts(maxes):
+    """Return where the new runs begin, for every collapse of the run length in `maxes`."""
+    return [i - int(maxes[i]) for i, _ in find_cps(maxes) if maxes[i] < maxes[i - 1]]
+
+
+def _coarse_to_fine(data, detect, factor, window):
+    """Detect change points on block averages of `data`, then refine each around it.
+    A short window needs a few steps more than the full series before the run length
+    collapses, so the refined change point is the start of the new run.
+    
+    Parameters:
+    - data : numpy array
+        The prepared BOCPD input.
+    - detect : callable
+        Runs the detector on an array and returns its maxes.
+    - factor : int
+        The number of rows averaged into one coarse row.
+    - window : int
+        The refinement runs on the rows within `window` of each coarse change point.
+        
+    Returns:
+    - anomalies : list
+        The refined change point indices.
+    """
+    starts = np.arange(0, len(data), factor)
+    counts = np.diff(np.append(starts, len(data)))
+    coarse = _minmax(np.add.reduceat(data, starts, axis=0) / counts[:, None])
+
+    anomalies = set()
+    for cp in _run_starts(detect(coarse)):
+        center = min(cp * factor, len(data))
+        lo, hi = max(center - window, 0), min(center + window, len(data))
+        # runs starting at either end of the window are not change points
+        refined = [lo + p for p in _run_starts(detect(data[lo:hi])) if 0 < p < hi - lo]
+        anomalies.update(refined if len(refined) > 0 else [center])
+    return sorted(anomalies)
+
+
+def bocpd_hazard_sweep(data, lams=(25, 50, 100, 250), likelihood="multivariate"):
+    """Perform BOCPD with several constant hazard rates in a single pass over the data.
+    The predictive probabilities are shared by every hazard rate, so calibrating the
+    sensitivity costs little more than a single `bocpd` run.
+    
+    Parameters:
+    - data : pandas DataFrame
+        The input data containing metrics from microservices.
+    - lams : list, optional
+        The expected run lengths of the constant hazard functions. Default is (25, 50, 100, 250).
+    - likelihood : str, optional
+        "multivariate" or "diagonal", see `bocpd`. Default is "multivariate".
         
-    data = data.to_numpy()
+    Returns:
+    - anomalies : dict
+        For each hazard rate in `lams`, the list of timestamps where anomalies were detected.
+    """
+    from functools import partial
+    from baro._bocpd import hazard_sweep, constant_hazard
+    likelihood_class = _likelihood_class(likelihood)
+    data, _ = _prepare(data)
 
-    R, maxes = online_changepoint_detection(
+    maxes = hazard_sweep(
         data,
+        [partial(constant_hazard, lam) for lam in lams],
+        likelihood_class(dims=data.shape[1], capacity=len(data) + 1),
+    )
+    return {lam: [p[0] for p in find_cps(m)] for lam, m in zip(lams, maxes)}
+
+
+def _univariate_maxes(series, max_run_length=None):
+    """Return the maxes of the univariate BOCPD on `series`, run in the worker processes of `univariate_bocpd`."""
+    from functools import partial
+    from baro._bocpd import truncated_online_changepoint_detection, constant_hazard, DiagonalT
+    _, maxes = truncated_online_changepoint_detection(
+        series[:, None],
         partial(constant_hazard, 50),
-        MultivariateT(dims=data.shape[1])
+        DiagonalT(dims=1, capacity=(max_run_length or len(series)) + 1),
+        max_run_length=max_run_length,
     )
-    cps = find_cps(maxes)
-    anomalies = [p[0] for p in cps]
-    # anomalies, merged_anomalies = find_anomalies(data=R[Nw,Nw:-1].tolist(), time_col=time_col)
+    return maxes
+
+
+def univariate_bocpd(data, n_jobs=None, fusion="max", tolerance=5, min_columns=1, max_run_length=None):
+    """Perform an independent univariate BOCPD on every latency and error metric and fuse the change points.
+    The metrics are spread over a process pool.
     
-    return anomalies
-    
\ No newline at end of file
+    Parameters:
+    - data : pandas DataFrame
+        The input data containing metrics from microservices.
+    - n_jobs : int, optional
+        The number of worker processes, 1 runs in the current process. Default is None (all cores).
+    - fusion : str, optional
+        How the change points of the metrics are fused into one change score. "max" scores each
+        timestep with the largest run length jump of any metric, "count" with the number of metrics
+        that changed within the last `tolerance` steps. Default is "max".
+    - tolerance : int, optional
+        Anomalies closer than `tolerance` steps are merged, and the metrics that changed within
+        `tolerance` steps of an anomaly are reported as its trigger. Default is 5.
+    - min_columns : int, optional
+        With the "count" fusion, the number of metrics that must change. Default is 1.
+    - max_run_length : int, optional
+        Run the truncated BOCPD, see `bocpd`. Default is None.
+        
+    Returns:
+    - dict
+        `anomalies` is the list of timestamps where anomalies were detected, `columns` the list of the
+        metrics that triggered each of them, and `scores` the fused change score of every timestep.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    assert fusion in ["max", "count"], f"{fusion} is not supported!"
+    data, columns = _prepare(data)
+
+    run = partial(_univariate_maxes, max_run_length=max_run_length)
+    if n_jobs == 1:
+        maxes = [run(series) for series in data.T]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            maxes = list(executor.map(run, data.T))
+    maxes = np.array(maxes).reshape(len(columns), len(data) + 1)
+
+    # run length jump of every metric at every timestep, the last maxes is never set by the detector
+    jumps = np.abs(np.diff(maxes[:, :-1], axis=1))
+    jumps = np.concatenate([np.zeros((len(columns), 1)), jumps], axis=1).T
+    jumps[jumps <= 1] = 0
+
+    if fusion == "max":
+        scores = jumps.max(axis=1, initial=0)
+        is_anomaly = scores > 0
+    else:
+        # changes[t] counts the changes of every metric before t
+        changes = np.concatenate([np.zeros((1, len(columns))), np.cumsum(jumps > 0, axis=0)])
+        steps = np.arange(len(jumps))
+        recent = changes[steps + 1] - changes[np.maximum(steps - tolerance, 0)]
+        scores = (recent > 0).sum(axis=1)
+        is_anomaly = scores >= min_columns
+
+    # merge anomalies closer than `tolerance` steps
+    anomalies = np.flatnonzero(is_anomaly)
+    anomalies = anomalies[np.concatenate([[True], np.diff(anomalies) > tolerance])[: len(anomalies)]]
+
+    triggers = []
+    for t in anomalies:
+        changed = (jumps[max(t - tolerance, 0) : t + tolerance + 1] > 0).any(axis=0)
+        triggers.append([columns[i] for i in np.flatnonzero(changed)])
+
+    return {
+        "anomalies": anomalies.tolist(),
+        "columns": triggers,
+        "scores": scores,
+    }
@@ -0,0 +1,301 @@
+import io
+import sqlite3
+import time
+
+import numpy as np
+
+
+def _nanpercentile(values, q, axis=0):
+    """The q-th percentiles (linear interpolation) of `values` along `axis`, ignoring NaNs.
+
+    The result is the same as `np.nanpercentile`, but every slice is sorted at once
+    (NaNs last) instead of one by one, and empty slices are NaN without a warning.
+    """
+    values = np.sort(values, axis=axis)
+    n = np.expand_dims(np.count_nonzero(~np.isnan(values), axis=axis), axis)
+    last = np.maximum(n - 1, 0)
+    percentiles = []
+    for p in np.atleast_1d(q):
+        h = last * (p / 100)
+        lo = np.floor(h).astype(int)
+        hi = np.minimum(lo + 1, last)
+        a = np.take_along_axis(values, lo, axis=axis)
+        b = np.take_along_axis(values, hi, axis=axis)
+        # the interpolation of np.percentile, from the closest bound
+        t = h - lo
+        with np.errstate(invalid="ignore"):
+            value = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+        percentiles.append(np.squeeze(np.where(n > 0, value, np.nan), axis=axis))
+    return np.stack(percentiles) if np.ndim(q) else percentiles[0]
+
+
+class Baseline:
+    """Per-metric statistics of a normal period: median, IQR, mean and (population) std.
+
+    RobustScorer only needs the median and IQR of the normal period, and nsigma only
+    its mean and std, so a baseline can replace the normal data in
+    `robust_scorer` and `nsigma`.
+    """
+
+    def __init__(self, columns, median, iqr, mean, std):
+        """
+        Parameters:
+        - columns : list
+            The metric names.
+        - median, iqr, mean, std : numpy.ndarray
+            The statistics of every metric, in the order of `columns`.
+        """
+        self.columns = list(columns)
+        self.median = np.asarray(median, dtype=float)
+        self.iqr = np.asarray(iqr, dtype=float)
+        self.mean = np.asarray(mean, dtype=float)
+        self.std = np.asarray(std, dtype=float)
+
+    @classmethod
+    def from_frame(cls, normal_df, dataset=None, **kwargs):
+        """Compute the baseline of a normal period, preprocessed like in `robust_scorer`.
+
+        Parameters:
+        - normal_df : pandas.DataFrame
+            The normal period.
+        - dataset : str, optional
+            The dataset name. Default is None.
+        - kwargs : dict
+            Additional keyword arguments, e.g. `dk_select_useful`.
+
+        Returns:
+        - Baseline
+            The statistics of every preprocessed metric.
+        """
+        from baro.root_cause_analysis import _unique_columns, preprocess
+        normal_df = _unique_columns(preprocess(
+            data=normal_df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+        ))
+        return cls.fit(normal_df.columns, normal_df.to_numpy(dtype=float))
+
+    @classmethod
+    def fit(cls, columns, normal):
+        """Compute the baseline of the normal values, one column per metric name, ignoring NaNs."""
+        q25, median, q75 = _nanpercentile(normal, [25, 50, 75], axis=0)
+        return cls(
+            columns,
+            median=median,
+            iqr=q75 - q25,
+            mean=np.nanmean(normal, axis=0),
+            std=np.nanstd(normal, axis=0),
+        )
+
+    def select(self, columns):
+        """Return the baseline of the `columns` it knows, in their order."""
+        index = {c: i for i, c in enumerate(self.columns)}
+        idx = np.array([index[c] for c in columns if c in index], dtype=int)
+        return Baseline(
+            [self.columns[i] for i in idx],
+            median=self.median[idx],
+            iqr=self.iqr[idx],
+            mean=self.mean[idx],
+            std=self.std[idx],
+        )
+
+    def to_bytes(self):
+        """Serialize the baseline as an .npz payload."""
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            columns=np.array(self.columns, dtype=str),
+            median=self.median,
+            iqr=self.iqr,
+            mean=self.mean,
+            std=self.std,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, payload):
+        """Deserialize a baseline written by `to_bytes`."""
+        with np.load(io.BytesIO(payload)) as arrays:
+            return cls(
+                arrays["columns"].tolist(),
+                median=arrays["median"],
+                iqr=arrays["iqr"],
+                mean=arrays["mean"],
+                std=arrays["std"],
+            )
+
+
+class BaselineStore:
+    """A SQLite store of baselines keyed by name (e.g. a service) and time window.
+
+    Entries older than `ttl` seconds are dropped when read, and once more than
+    `max_entries` are stored the least recently used ones are evicted.
+    """
+
+    def __init__(self, path=":memory:", ttl=None, max_entries=128):
+        """
+        Parameters:
+        - path : str, optional
+            The SQLite database file. Default is ":memory:" (not persisted).
+        - ttl : float, optional
+            The number of seconds a baseline stays valid. Default is None (forever).
+        - max_entries : int, optional
+            The maximum number of baselines kept. Default is 128.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS baselines ("
+            "key TEXT PRIMARY KEY, created REAL, accessed REAL, payload BLOB)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def key(name, start, end):
+        """The key of the baseline of `name` over the time window [start, end)."""
+        return f"{name}@{start}:{end}"
+
+    def get(self, name, start, end, columns=None):
+        """Return the stored baseline of `name` over [start, end), or None if missing or expired.
+
+        Parameters:
+        - name : str
+            The baseline name.
+        - start, end : int
+            The time window of the normal period.
+        - columns : list, optional
+            Only return the statistics of these metrics. Default is None (all).
+        """
+        key = self.key(name, start, end)
+        row = self.connection.execute(
+            "SELECT created, payload FROM baselines WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if self.ttl is not None and now - row[0] >= self.ttl:
+            self.connection.execute("DELETE FROM baselines WHERE key = ?", (key,))
+            self.connection.commit()
+            return None
+        self.connection.execute("UPDATE baselines SET accessed = ? WHERE key = ?", (now, key))
+        self.connection.commit()
+
+        baseline = Baseline.from_bytes(row[1])
+        return baseline if columns is None else baseline.select(columns)
+
+    def put(self, name, start, end, baseline):
+        """Store the baseline of `name` over [start, end), evicting the least recently used ones."""
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO baselines VALUES (?, ?, ?, ?)",
+            (self.key(name, start, end), now, now, baseline.to_bytes()),
+        )
+        self.connection.execute(
+            "DELETE FROM baselines WHERE key NOT IN "
+            "(SELECT key FROM baselines ORDER BY accessed DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM baselines").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class SlidingRobustStats:
+    """The baseline of the last `window` rows of a metric stream, updated incrementally.
+
+    Every column keeps its window values sorted (missing values are stored as +inf at
+    the end), so an update removes the oldest value and inserts the new one with a
+    vectorized shift over all columns, in O(window * columns) time and memory.
+    The percentiles are exact and match `np.nanpercentile`.
+    """
+
+    def __init__(self, columns, window):
+        """
+        Parameters:
+        - columns : list
+            The metric names, in the order of the values passed to `update`.
+        - window : int
+            The number of most recent rows the statistics are computed on.
+        """
+        self.columns = list(columns)
+        self.window = window
+        dims = len(self.columns)
+        self.ring = np.full((window, dims), np.inf)
+        self.sorted = np.full((window, dims), np.inf)
+        self.head = 0
+        self.count = np.zeros(dims, dtype=int)
+
+    def _push(self, row):
+        old = self.ring[self.head].copy()
+        self.ring[self.head] = row
+        self.head = (self.head + 1) % self.window
+
+        # remove `old` from its position p, insert `row` at its position q in what remains
+        rows = np.arange(self.window)[:, None]
+        p = (self.sorted < old).sum(axis=0)
+        q = (self.sorted < row).sum(axis=0) - (old < row)
+        src = np.where(rows < q, rows, rows - 1)
+        src += src >= p
+        self.sorted = np.take_along_axis(self.sorted, np.clip(src, 0, self.window - 1), axis=0)
+        self.sorted[q, np.arange(len(q))] = row
+
+        self.count += np.isfinite(row).astype(int) - np.isfinite(old)
+
+    def update(self, values):
+        """Add one row (1-D) or a batch of rows (2-D) of metric values; NaN marks a missing value."""
+        values = np.asarray(values, dtype=float)
+        values = np.where(np.isnan(values), np.inf, values)
+        if values.ndim == 1:
+            self._push(values)
+            return
+        if len(values) >= self.window:
+            # only the last window matters, sort it at once
+            self.ring = values[-self.window :].copy()
+            self.sorted = np.sort(self.ring, axis=0)
+            self.head = 0
+            self.count = np.isfinite(self.ring).sum(axis=0)
+            return
+        for row in values:
+            self._push(row)
+
+    def percentile(self, q):
+        """The q-th percentile (linear interpolation) of every column, NaN for empty columns."""
+        n = self.count
+        h = (np.maximum(n, 1) - 1) * q / 100
+        lo = np.floor(h).astype(int)
+        hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+        cols = np.arange(len(n))
+        a, b = self.sorted[lo, cols], self.sorted[hi, cols]
+        with np.errstate(invalid="ignore"):
+            value = a + (h - lo) * (b - a)
+        value = np.where(hi == lo, a, value)
+        return np.where(n > 0, value, np.nan)
+
+    def baseline(self):
+        """Return the baseline of the current window, preprocessed like in `Baseline.from_frame`.
+
+        Time columns and the columns constant over the window are dropped, and memory
+        values are converted to MBs.
+        """
+        n = self.count
+        cols = np.arange(len(n))
+        q25, median, q75 = (self.percentile(q) for q in (25, 50, 75))
+        # two passes over the window, running sums of squares cancel for large values
+        finite = np.isfinite(self.ring)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(finite, self.ring, 0).sum(axis=0) / n
+            std = np.sqrt((np.where(finite, self.ring - mean, 0) ** 2).sum(axis=0) / n)
+
+        keep = self.sorted[np.maximum(n - 1, 0), cols] > self.sorted[0, cols]
+        keep &= ~np.isin(self.columns, ["time", "Time", "timestamp"])
+        unit = np.array([1e6 if c.endswith("_mem") else 1.0 for c in self.columns])
+        return Baseline(
+            [c for c, k in zip(self.columns, keep) if k],
+            median=(median / unit)[keep],
+            iqr=((q75 - q25) / unit)[keep],
+            mean=(mean / unit)[keep],
+            std=(std / unit)[keep],
+        )
@@ -12,6 +12,7 @@ from metric import normalize_bucket_counts
 from metric import process_bucket_counts
 from metric import process_files_in_folder
 from metric import calculate_weighted_sum
+from metric import weighted_sums
 from metric import add_latency_columns
 from metric import re_read_csv_file
 from metric import process_data
@@ -51,9 +52,9 @@ def metric_runner(input_dir, output_dir):
             df = pd.read_csv(file_path)
 
             # 计算加权和
-            df['P90'] = df['Latency_P90'].apply(lambda x: calculate_weighted_sum(x, weights)) / 10
-            df['P95'] = df['Latency_P95'].apply(lambda x: calculate_weighted_sum(x, weights)) / 5
-            df['P99'] = df['Latency_P99'].apply(lambda x: calculate_weighted_sum(x, weights))
+            df['P90'] = weighted_sums(df['Latency_P90'], weights) / 10
+            df['P95'] = weighted_sums(df['Latency_P95'], weights) / 5
+            df['P99'] = weighted_sums(df['Latency_P99'], weights)
 
             # 添加client和server延迟的列
             df = add_latency_columns(df)
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import os
 import ast
 
@@ -23,15 +24,29 @@ def split_and_save_by_service(df, output_folder):
         print(f"Saved: {output_file}")
 
 
+# 将BucketCounts字符串一次性解析为二维数组(行 × 桶), 桶数不同的行用0补齐
+def parse_bucket_counts(bucket_counts):
+    items = pd.Series(bucket_counts).astype(str).str.strip("[] ").to_numpy()
+    lengths = np.array([0 if item == "" else item.count(",") + 1 for item in items], dtype=int)
+    counts = np.zeros((len(items), lengths.max(initial=0)))
+    if lengths.any():
+        counts[np.arange(counts.shape[1]) < lengths[:, None]] = np.array(
+            ",".join(items[lengths > 0]).split(","), dtype=float
+        )
+    return counts, lengths
+
+
+# 将二维数组按行转换回列表字符串
+def format_bucket_counts(counts, lengths):
+    return [str(row[:n].tolist()) for row, n in zip(counts, lengths)]
+
+
 # 处理BucketCounts列的函数
 def normalize_bucket_counts(df):
-    def normalize(row):
-        bucket_counts = eval(row['BucketCounts'])  # 使用eval将字符串转换为列表
-        count = row['Count']
-        normalized_counts = [value / count for value in bucket_counts]
-        return str(normalized_counts)  # 返回字符串形式
-
-    df['BucketCounts'] = df.apply(normalize, axis=1)
+    counts, lengths = parse_bucket_counts(df['BucketCounts'])
+    # 所有行一次性除以Count
+    counts = counts / df['Count'].to_numpy()[:, None]
+    df['BucketCounts'] = format_bucket_counts(counts, lengths)  # 返回字符串形式
     return df
 
 
@@ -59,6 +74,24 @@ def process_bucket_counts(bucket_counts_str, percentage):
     return percentages
 
 
+# 一次性计算所有行的延迟百分比, 与process_bucket_counts的结果相同
+def bucket_percentages(counts, percentage):
+    padded = np.pad(counts, ((0, 0), (1, 1)))
+    # 与sum相同, 从左到右累加
+    total = np.cumsum(padded, axis=1)[:, -1:]
+    target = total * percentage  # 计算目标数据量
+
+    # 从最后一个桶往前累加, accumulated为每个桶之前已累加的数据量, reached为包含该桶后的数据量
+    reversed_cumsum = np.cumsum(padded[:, ::-1], axis=1)[:, ::-1]
+    accumulated, reached = reversed_cumsum[:, 2:], reversed_cumsum[:, 1:-1]
+
+    # 未达到目标的桶取全部数据, 达到目标的桶只取所需部分, 之后的桶为0
+    needed = np.where(reached >= target, target - accumulated, counts)
+    needed = np.where(accumulated < target, needed, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(needed > 0, needed / total * 100, 0)  # 计算百分比
+
+
 # 处理文件夹中的所有CSV文件
 def process_files_in_folder(folder_path):
     for filename in os.listdir(folder_path):
@@ -68,12 +101,15 @@ def process_files_in_folder(folder_path):
 
             # 确保 'BucketCounts' 列存在并进行归一化
             if 'BucketCounts' in df:
-                df = normalize_bucket_counts(df)
+                # 只解析一次BucketCounts
+                counts, lengths = parse_bucket_counts(df['BucketCounts'])
+                counts = counts / df['Count'].to_numpy()[:, None]
+                df['BucketCounts'] = format_bucket_counts(counts, lengths)
 
                 # 计算延迟百分比
-                df['Latency_P90'] = df['BucketCounts'].apply(lambda x: process_bucket_counts(x, 0.10))
-                df['Latency_P95'] = df['BucketCounts'].apply(lambda x: process_bucket_counts(x, 0.05))
-                df['Latency_P99'] = df['BucketCounts'].apply(lambda x: process_bucket_counts(x, 0.01))
+                df['Latency_P90'] = format_bucket_counts(bucket_percentages(counts, 0.10), lengths)
+                df['Latency_P95'] = format_bucket_counts(bucket_percentages(counts, 0.05), lengths)
+                df['Latency_P99'] = format_bucket_counts(bucket_percentages(counts, 0.01), lengths)
 
                 # 保存修改后的文件
                 df.to_csv(file_path, index=False)
@@ -89,6 +125,12 @@ def calculate_weighted_sum(latency_values, weights):
     return weighted_sum
 
 
+# 一次矩阵向量乘法计算所有行的加权和
+def weighted_sums(latency_values, weights):
+    latency, _ = parse_bucket_counts(latency_values)
+    return latency @ np.asarray(weights, dtype=float)[:latency.shape[1]]
+
+
 # 添加client和server延迟的列
 def add_latency_columns(df):
     df['client_P90'] = 0
@@ -183,9 +225,9 @@ def main(input_file, output_folder):
             df = pd.read_csv(file_path)
 
             # 计算加权和
-            df['P90'] = df['Latency_P90'].apply(lambda x: calculate_weighted_sum(x, weights)) / 10
-            df['P95'] = df['Latency_P95'].apply(lambda x: calculate_weighted_sum(x, weights)) / 5
-            df['P99'] = df['Latency_P99'].apply(lambda x: calculate_weighted_sum(x, weights))
+            df['P90'] = weighted_sums(df['Latency_P90'], weights) / 10
+            df['P95'] = weighted_sums(df['Latency_P95'], weights) / 5
+            df['P99'] = weighted_sums(df['Latency_P99'], weights)
 
             # 添加client和server延迟的列
             df = add_latency_columns(df)
@@ -1,7 +1,10 @@
+import warnings
+
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import RobustScaler, StandardScaler
 
-from .utility import drop_time, drop_constant, drop_near_constant
+from .baseline import Baseline, _nanpercentile
+from .utility import MetricSchema
 
 
 def select_useful_cols(data):
@@ -15,26 +18,17 @@ def select_useful_cols(data):
     - selected_cols : list
         A list of selected column names.
     """
-    selected_cols = []
-    for c in data.columns:
-        # keep time
-        if "time" in c:
-            selected_cols.append(c)
-
-        # cpu
-        if c.endswith("_cpu") and data[c].std() > 1:
-            selected_cols.append(c)
-
-        # mem
-        if c.endswith("_mem") and data[c].std() > 1:
-            selected_cols.append(c)
-
-        # latency
-        # if ("lat50" in c or "latency" in c) and (data[c] * 1000).std() > 10:
-        if "lat50" in c and (data[c] * 1000).std() > 10:
-            selected_cols.append(c)
-    return selected_cols
-
+    schema = MetricSchema.of(data.columns)
+    useful = schema.contains("time").astype(int)
+    # cpu, mem
+    usage = schema.endswith("_cpu", "_mem")
+    useful[usage] += (data.loc[:, usage].std() > 1).to_numpy()
+    # latency
+    # if ("lat50" in c or "latency" in c) and (data[c] * 1000).std() > 10:
+    lat50 = schema.contains("lat50")
+    useful[lat50] += ((data.loc[:, lat50] * 1000).std() > 10).to_numpy()
+    # a column matching several criteria is selected several times
+    return data.columns[np.repeat(np.arange(len(useful)), useful)].to_list()
 
 
 def drop_extra(df: pd.DataFrame):
@@ -53,22 +47,11 @@ def drop_extra(df: pd.DataFrame):
 
     # remove cols has "frontend-external" in name
     # remove cols start with "main_" or "PassthroughCluster_", etc.
-    for col in df.columns:
-        if (
-            "frontend-external" in col
-            or col.startswith("main_")
-            or col.startswith("PassthroughCluster_")
-            or col.startswith("redis_")
-            or col.startswith("rabbitmq")
-            or col.startswith("queue")
-            or col.startswith("session")
-            or col.startswith("istio-proxy")
-        ):
-            df = df.drop(columns=[col])
-
-    return df
-
-
+    schema = MetricSchema.of(df.columns)
+    extra = schema.contains("frontend-external") | schema.startswith(
+        "main_", "PassthroughCluster_", "redis_", "rabbitmq", "queue", "session", "istio-proxy"
+    )
+    return df.loc[:, ~extra]
 
 
 def convert_mem_mb(df: pd.DataFrame):
@@ -93,6 +76,68 @@ def convert_mem_mb(df: pd.DataFrame):
     return df.apply(update_mem)
 
 
+def column_profile(data):
+    """Profile all columns of the dataset, but the time ones, in one pass.
+    
+    Parameters:
+    - data : pandas.DataFrame
+        The dataset to profile.
+        
+    Returns:
+    - profile : dict
+        The profiled "columns" ("frame"), their name masks ("extra", "cpu", "mem",
+        "lat50", "time"), which of them are "numeric", their float values in MBs
+        for memory ("values", NaN for the non-numeric ones), whether they differ
+        from their first row at all ("changing") and how often ("change_fraction"),
+        their sample std ("std") and, for latencies, their sample std in
+        milliseconds ("lat50_std"). Only the constancy of non-numeric columns is
+        profiled, their std is NaN.
+    """
+    data = data.loc[:, ~data.columns.isin(["time", "Time", "timestamp"])]
+    schema = MetricSchema.of(data.columns)
+    profile = {
+        "frame": data,
+        "columns": data.columns,
+        "numeric": data.dtypes.map(pd.api.types.is_numeric_dtype).to_numpy(dtype=bool),
+        "extra": (
+            (schema.columns == "time.1")
+            | schema.contains("frontend-external")
+            | schema.startswith(
+                "main_", "PassthroughCluster_", "redis_", "rabbitmq", "queue", "session", "istio-proxy"
+            )
+        ),
+        "cpu": schema.endswith("_cpu"),
+        "mem": schema.endswith("_mem"),
+        "lat50": schema.contains("lat50"),
+        "time": schema.contains("time"),
+    }
+
+    numeric = profile["numeric"]
+    if numeric.all():
+        values = data.to_numpy(dtype=float)
+    else:
+        values = np.full(data.shape, np.nan)
+        values[:, numeric] = data.loc[:, numeric].to_numpy(dtype=float)
+    values[:, profile["mem"] & numeric] /= 1e6
+    # NaN differs from everything, like in `df != df.iloc[0]`
+    changes = values != values[0]
+    if not numeric.all():
+        # e.g. labels, compared as they are
+        others = data.loc[:, ~numeric]
+        changes[:, ~numeric] = (others != others.iloc[0]).to_numpy(dtype=bool)
+    profile["values"] = values
+    profile["changing"] = changes.any(axis=0)
+    profile["change_fraction"] = changes.mean(axis=0)
+    profile["lat50_std"] = np.full(len(schema.columns), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        profile["std"] = np.nanstd(values, axis=0, ddof=1)
+        profile["lat50_std"][profile["lat50"]] = np.nanstd(
+            values[:, profile["lat50"]] * 1000, axis=0, ddof=1
+        )
+    return profile
+
+
 def preprocess(data, dataset=None, dk_select_useful=False):
     """Preprocess the dataset.
     
@@ -108,20 +153,116 @@ def preprocess(data, dataset=None, dk_select_useful=False):
     - data : pandas.DataFrame
         The preprocessed dataset.
     """
-    data = drop_constant(drop_time(data))
-    data = convert_mem_mb(data)
+    # same selection as drop_time, drop_constant, convert_mem_mb and, with dk_select_useful,
+    # drop_extra, drop_near_constant and select_useful_cols, from a single profile
+    profile = column_profile(data)
+    counts = profile["changing"].astype(int)
 
     if dk_select_useful is True:
-        data = drop_extra(data)
-        data = drop_near_constant(data)
-        data = data[select_useful_cols(data)]
+        keep = profile["changing"] & ~profile["extra"] & (profile["change_fraction"] > 0.1)
+        # a column is selected once for every rule it matches, like in select_useful_cols
+        counts = keep * (
+            profile["time"].astype(int)
+            + ((profile["cpu"] | profile["mem"]) & (profile["std"] > 1))
+            + (profile["lat50_std"] > 10)
+        )
+
+    idx = np.repeat(np.arange(len(counts)), counts)
+    data = pd.DataFrame(profile["values"][:, idx], index=data.index, columns=profile["columns"][idx])
+    # the selected non-numeric columns are kept as they are
+    for j in np.flatnonzero(~profile["numeric"][idx]):
+        data.isetitem(j, profile["frame"].iloc[:, idx[j]])
     return data
 
 
+def _cut(data, inject_time=None, anomalies=None):
+    """Cut the dataset into its normal and anomalous periods."""
+    if anomalies is None:
+        normal_df = data[data["time"] < inject_time]
+        anomal_df = data[data["time"] >= inject_time]
+    else:
+        normal_df = data.head(anomalies[0])
+        # anomal_df is the rest
+        anomal_df = data.tail(len(data) - anomalies[0])
+    return normal_df, anomal_df
 
 
+def _unique_columns(df):
+    """Keep the first of the columns `preprocess` selected several times, they hold the same values."""
+    return df.loc[:, ~df.columns.duplicated()]
 
-def nsigma(data, inject_time=None, dataset=None, num_loop=None, sli=None, anomalies=None, **kwargs):
+
+def _split(data, inject_time=None, anomalies=None, dataset=None, baseline=None, **kwargs):
+    """Split the dataset into the baseline of its normal period and its anomalous period, on their common columns.
+    
+    Parameters:
+    - data : pandas.DataFrame
+        The dataset to split.
+    - inject_time : int, optional
+        The time of fault injection time. Default is None.
+    - anomalies : list, optional
+        List of anomalies, the first one starts the anomalous period. Default is None.
+    - dataset : str, optional
+        The dataset name. Default is None.
+    - baseline : Baseline, optional
+        A precomputed baseline of the normal period, whose data is then not used. Default is None.
+    - kwargs : dict
+        Additional keyword arguments.
+        
+    Returns:
+    - baseline : Baseline
+        The statistics of the preprocessed normal period.
+    - anomal_df : pandas.DataFrame
+        The preprocessed anomalous period, with the columns of `baseline`.
+    """
+    normal_df, anomal_df = _cut(data, inject_time=inject_time, anomalies=anomalies)
+    anomal_df = _unique_columns(preprocess(
+        data=anomal_df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+    ))
+
+    if baseline is None:
+        normal_df = _unique_columns(preprocess(
+            data=normal_df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+        ))
+        # intersect
+        intersects = [x for x in normal_df.columns if x in anomal_df.columns]
+        baseline = Baseline.fit(intersects, normal_df[intersects].to_numpy(dtype=float))
+    else:
+        baseline = baseline.select(anomal_df.columns)
+    return baseline, anomal_df[baseline.columns]
+
+
+def _rank(columns, anomal, center, scale):
+    """Rank the columns by the maximum z-score of their anomalous values.
+    
+    Parameters:
+    - columns : list
+        The column names.
+    - anomal : numpy.ndarray
+        The anomalous values, one column per name.
+    - center, scale : numpy.ndarray
+        The center and scale of every column, as fitted on the normal period.
+        
+    Returns:
+    - ranks : list
+        The column names, from the highest to the lowest score (ties keep the column order).
+    """
+    scores = _max_zscore(anomal, center, scale, axis=0)
+    return [columns[i] for i in np.argsort(-scores, kind="stable")]
+
+
+def _max_zscore(anomal, center, scale, axis):
+    """The maximum z-score of the anomalous values along `axis`, skipping missing values."""
+    # zero scales are replaced by 1, like sklearn scalers do
+    scale = np.where(scale < 10 * np.finfo(float).eps, 1.0, scale)
+    zscores = (anomal - center) / scale
+    # a missing sample does not hide the others, all-missing columns score -inf
+    return np.where(np.isnan(zscores), -np.inf, zscores).max(axis=axis)
+
+
+def nsigma(
+    data, inject_time=None, dataset=None, num_loop=None, sli=None, anomalies=None, baseline=None, **kwargs
+):
     """Perform nsigma analysis on the dataset.
     
     Parameters:
@@ -137,6 +278,8 @@ def nsigma(data, inject_time=None, dataset=None, num_loop=None, sli=None, anomal
         SLI (Service Level Indicator). Default is None.
     - anomalies : list, optional
         List of anomalies. Default is None.
+    - baseline : Baseline, optional
+        A precomputed baseline of the normal period (e.g. from a BaselineStore). Default is None.
     - kwargs : dict
         Additional keyword arguments.
         
@@ -144,49 +287,26 @@ def nsigma(data, inject_time=None, dataset=None, num_loop=None, sli=None, anomal
     - dict
         A dictionary containing node names and ranks.
     """
-    if anomalies is None:
-        normal_df = data[data["time"] < inject_time]
-        anomal_df = data[data["time"] >= inject_time]
-    else:
-        normal_df = data.head(anomalies[0])
-        # anomal_df is the rest
-        anomal_df = data.tail(len(data) - anomalies[0])
-
-    normal_df = preprocess(
-        data=normal_df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+    baseline, anomal_df = _split(
+        data, inject_time=inject_time, anomalies=anomalies, dataset=dataset, baseline=baseline, **kwargs
     )
 
-    anomal_df = preprocess(
-        data=anomal_df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+    # the z-score of StandardScaler, for all columns at once
+    ranks = _rank(
+        baseline.columns,
+        anomal_df.to_numpy(dtype=float),
+        center=baseline.mean,
+        scale=baseline.std,
     )
 
-    # intersect
-    intersects = [x for x in normal_df.columns if x in anomal_df.columns]
-    normal_df = normal_df[intersects]
-    anomal_df = anomal_df[intersects]
-
-    ranks = []
-
-    for col in normal_df.columns:
-        a = normal_df[col].to_numpy()
-        b = anomal_df[col].to_numpy()
-
-        scaler = StandardScaler().fit(a.reshape(-1, 1))
-        zscores = scaler.transform(b.reshape(-1, 1))[:, 0]
-        score = max(zscores)
-        ranks.append((col, score))
-
-    ranks = sorted(ranks, key=lambda x: x[1], reverse=True)
-    ranks = [x[0] for x in ranks]
-
     return {
-        "node_names": normal_df.columns.to_list(),
+        "node_names": baseline.columns,
         "ranks": ranks,
     }
 
 
 def robust_scorer(
-    data, inject_time=None, dataset=None, num_loop=None, sli=None, anomalies=None, **kwargs
+    data, inject_time=None, dataset=None, num_loop=None, sli=None, anomalies=None, baseline=None, **kwargs
 ):
     """Perform root cause analysis using RobustScorer.
     
@@ -203,6 +323,9 @@ def robust_scorer(
         SLI (Service Level Indicator). Default is None. Just for future API compatible
     - anomalies : list, optional
         List of anomalies. Default is None.
+    - baseline : Baseline, optional
+        A precomputed baseline of the normal period (e.g. from a BaselineStore), so that only
+        the anomalous period of `data` is used. Default is None.
     - kwargs : dict
         Additional keyword arguments.
         
@@ -210,44 +333,96 @@ def robust_scorer(
     - dict
         A dictionary containing node names and ranks. `ranks` is a ranked list of root causes.
     """
-    if anomalies is None:
-        normal_df = data[data["time"] < inject_time]
-        anomal_df = data[data["time"] >= inject_time]
-    else:
-        normal_df = data.head(anomalies[0])
-        # anomal_df is the rest
-        anomal_df = data.tail(len(data) - anomalies[0])
-
-    normal_df = preprocess(
-        data=normal_df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+    baseline, anomal_df = _split(
+        data, inject_time=inject_time, anomalies=anomalies, dataset=dataset, baseline=baseline, **kwargs
     )
 
-    anomal_df = preprocess(
-        data=anomal_df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+    # the median / IQR z-score of RobustScaler, for all columns at once
+    ranks = _rank(
+        baseline.columns,
+        anomal_df.to_numpy(dtype=float),
+        center=baseline.median,
+        scale=baseline.iqr,
     )
 
-    # intersect
-    intersects = [x for x in normal_df.columns if x in anomal_df.columns]
-    normal_df = normal_df[intersects]
-    anomal_df = anomal_df[intersects]
-
-    ranks = []
-
-    for col in normal_df.columns:
-        a = normal_df[col].to_numpy()
-        b = anomal_df[col].to_numpy()
-
-        scaler = RobustScaler().fit(a.reshape(-1, 1))
-        zscores = scaler.transform(b.reshape(-1, 1))[:, 0]
-        score = max(zscores)
-        ranks.append((col, score))
-
-    ranks = sorted(ranks, key=lambda x: x[1], reverse=True)
-    ranks = [x[0] for x in ranks]
-
     return {
-        "node_names": normal_df.columns.to_list(),
+        "node_names": baseline.columns,
         "ranks": ranks,
     }
 
 
+def robust_scorer_batch(datas, inject_times=None, dataset=None, anomalies=None, **kwargs):
+    """Perform root cause analysis using RobustScorer on many cases at once.
+    
+    The preprocessed cases are stacked into NaN-padded (case, time, column) arrays over
+    the union of their columns, and all of them are scored in one vectorized pass.
+    The output of every case is the same as `robust_scorer` on it.
+    
+    Parameters:
+    - datas : list of pandas.DataFrame
+        The cases to perform RobustScorer.
+    - inject_times : list of int, optional
+        The time of fault injection time of every case. Default is None.
+    - dataset : str, optional
+        The dataset name. Default is None.
+    - anomalies : list of list, optional
+        List of anomalies of every case. Default is None.
+    - kwargs : dict
+        Additional keyword arguments.
+        
+    Returns:
+    - list of dict
+        A dictionary containing node names and ranks for every case.
+    """
+    cases = []
+    for i, data in enumerate(datas):
+        normal_df, anomal_df = _cut(
+            data,
+            inject_time=None if inject_times is None else inject_times[i],
+            anomalies=None if anomalies is None else anomalies[i],
+        )
+        normal_df, anomal_df = (
+            _unique_columns(preprocess(
+                data=df, dataset=dataset, dk_select_useful=kwargs.get("dk_select_useful", False)
+            ))
+            for df in (normal_df, anomal_df)
+        )
+        intersects = [x for x in normal_df.columns if x in anomal_df.columns]
+        # select the common columns on the arrays, cheaper than on the frames
+        cases.append((
+            intersects,
+            normal_df.to_numpy(dtype=float)[:, normal_df.columns.get_indexer(intersects)],
+            anomal_df.to_numpy(dtype=float)[:, anomal_df.columns.get_indexer(intersects)],
+        ))
+    if len(datas) == 0:
+        return []
+
+    # the union of the columns, and the position of every one of them in every case
+    columns = list(dict.fromkeys(c for names, _, _ in cases for c in names))
+    index = {c: j for j, c in enumerate(columns)}
+    position = np.full((len(datas), len(columns)), len(columns))
+    for i, (names, _, _) in enumerate(cases):
+        position[i, [index[c] for c in names]] = np.arange(len(names))
+
+    def stack(period):
+        values = np.full((len(cases), max(len(case[period]) for case in cases), len(columns)), np.nan)
+        for i, case in enumerate(cases):
+            values[i, : len(case[period]), [index[c] for c in case[0]]] = case[period].T
+        return values
+
+    # the padding is skipped like missing values, by _nanpercentile and by _max_zscore
+    normal, anomal = stack(1), stack(2)
+    q25, median, q75 = _nanpercentile(normal, [25, 50, 75], axis=1)
+    scores = _max_zscore(anomal, median[:, None], (q75 - q25)[:, None], axis=1)
+
+    # highest score first, ties in the column order of the case, missing columns last
+    scores[position == len(columns)] = np.nan
+    order = np.lexsort((position, -scores), axis=-1)
+
+    outputs = []
+    for i, (names, _, _) in enumerate(cases):
+        outputs.append({
+            "node_names": names,
+            "ranks": [columns[j] for j in order[i, : len(names)]],
+        })
+    return outputs
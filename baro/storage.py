@@ -0,0 +1,91 @@
+import json
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+
+class MetricStore:
+    """A binary store of a metric history, sorted by time and read by memory-mapped windows.
+
+    The store is a directory with the sorted `time` index (time.npy), a dense float32
+    matrix of the metric values, one row per time (values.npy), and the column
+    names (columns.json). Reading the `[t0, t1)` window only touches its rows.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+        - path : str
+            The store directory, as written by `MetricStore.write`.
+        """
+        self.path = path
+        with open(join(path, "columns.json")) as f:
+            self.columns = json.load(f)
+        self.index = {c: i for i, c in enumerate(self.columns)}
+        self.time = np.load(join(path, "time.npy"), mmap_mode="r")
+        self.values = np.load(join(path, "values.npy"), mmap_mode="r")
+
+    @classmethod
+    def write(cls, path, data):
+        """Write the metrics of `data` to a new store.
+
+        Parameters:
+        - path : str
+            The store directory, created if missing.
+        - data : pandas.DataFrame
+            The metrics, with a `time` column.
+
+        Returns:
+        - MetricStore
+            The store, opened for reading.
+        """
+        os.makedirs(path, exist_ok=True)
+        data = data.sort_values("time", kind="stable")
+        columns = [c for c in data.columns if c != "time"]
+        np.save(join(path, "time.npy"), data["time"].to_numpy())
+        np.save(join(path, "values.npy"), data[columns].to_numpy(dtype=np.float32))
+        with open(join(path, "columns.json"), "w") as f:
+            json.dump(columns, f)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.time)
+
+    def rows(self, t0=None, t1=None):
+        """The row slice of the `[t0, t1)` time window, open-ended when a bound is None."""
+        start = 0 if t0 is None else np.searchsorted(self.time, t0, side="left")
+        stop = len(self.time) if t1 is None else np.searchsorted(self.time, t1, side="left")
+        return slice(int(start), int(stop))
+
+    def window(self, t0=None, t1=None, columns=None):
+        """Read the metrics of the `[t0, t1)` time window.
+
+        Parameters:
+        - t0, t1 : int, optional
+            The time window, open-ended when a bound is None.
+        - columns : list, optional
+            The metrics to read. Default is None (all of them).
+
+        Returns:
+        - data : pandas.DataFrame
+            The `time` column and the metrics. Without `columns`, the metrics are a
+            read-only view of the memory-mapped file.
+        """
+        return self._frame(self.rows(t0, t1), columns)
+
+    def around(self, inject_time, length=300):
+        """Read the `length` rows before and the `length` rows from the injection time, like `read_data`."""
+        split = self.rows(t1=inject_time).stop
+        return self._frame(slice(max(split - length, 0), split + length), None)
+
+    def _frame(self, rows, columns):
+        values = self.values[rows]
+        if columns is None:
+            columns = self.columns
+        else:
+            values = values[:, [self.index[c] for c in columns]]
+        data = pd.DataFrame(values, columns=columns, copy=False)
+        data.insert(0, "time", self.time[rows])
+        return data
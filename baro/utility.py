@@ -3,6 +3,7 @@ import glob
 import shutil
 import requests
 import json
+import tempfile
 import zipfile
 from os.path import join, basename, dirname, exists
 
@@ -10,6 +11,7 @@ import numpy as np
 from tqdm import tqdm
 import pandas as pd
 import matplotlib.pyplot as plt
+from functools import lru_cache
 
 
 def download_online_boutique_dataset(local_path=None):
@@ -54,6 +56,67 @@ def download_train_ticket_dataset(local_path=None):
     os.remove("fse-tt.zip")
     
 
+class MetricSchema:
+    """The service and metric kind of every `<service>_<metric>` column, parsed once.
+
+    The services and metric kinds are factorized into integer codes (in order of first
+    appearance), and name masks are computed once and cached, so that selecting and
+    grouping columns are array operations.
+    """
+
+    def __init__(self, columns):
+        self.columns = pd.Index(columns)
+        names = pd.Series(self.columns.astype(str))
+        parts = names.str.split("_", n=1, expand=True).reindex(columns=[0, 1])
+        # columns without "_" are their own service, with no metric kind (code -1)
+        self.service_codes, self.services = pd.factorize(parts[0])
+        self.metric_codes, self.metrics = pd.factorize(parts[1])
+        self.parsed = self.metric_codes >= 0
+        self._names = names
+        self._masks = {}
+
+    @classmethod
+    def of(cls, columns):
+        """Return the schema of `columns`, shared by every frame with the same columns."""
+        return _metric_schema(tuple(columns))
+
+    def _mask(self, method, pattern):
+        key = (method, pattern)
+        if key not in self._masks:
+            if method == "contains":
+                mask = self._names.str.contains(pattern, regex=False)
+            else:
+                mask = getattr(self._names.str, method)(pattern)
+            self._masks[key] = mask.to_numpy(dtype=bool)
+        return self._masks[key]
+
+    def contains(self, *patterns):
+        """The mask of the columns whose name contains any of `patterns`."""
+        return np.logical_or.reduce([self._mask("contains", p) for p in patterns])
+
+    def startswith(self, *prefixes):
+        """The mask of the columns whose name starts with any of `prefixes`."""
+        return np.logical_or.reduce([self._mask("startswith", p) for p in prefixes])
+
+    def endswith(self, *suffixes):
+        """The mask of the columns whose name ends with any of `suffixes`."""
+        return np.logical_or.reduce([self._mask("endswith", p) for p in suffixes])
+
+    def groups(self, by="service"):
+        """Return the column indices of every service (or metric kind, `by="metric"`), by code."""
+        codes, uniques = (
+            (self.service_codes, self.services) if by == "service" else (self.metric_codes, self.metrics)
+        )
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        return [order[bounds[i] : bounds[i + 1]] for i in range(len(uniques))]
+
+
+@lru_cache(maxsize=32)
+def _metric_schema(columns):
+    return MetricSchema(list(columns))
+
+
 def load_json(filename: str):
     """Load data from a JSON file."""
     with open(filename) as f:
@@ -88,33 +151,21 @@ def visualize_metrics(data: pd.DataFrame, filename=None, figsize=None):
         figsize = (25, 25)
 
     data = drop_time(data)
-    services = []
-    metrics = []
-    for c in data.columns:
-        try:
-            service, metric_name = c.split("_", 1)
-        except Exception as e:
-            print(f"Can not parse {c}")
-            continue  # ignore
-            # raise e
-        if service not in services:
-            services.append(service)
-        if metric_name not in metrics:
-            metrics.append(metric_name)
-
-    n_services = len(services)
-    n_metrics = len(metrics)
+    schema = MetricSchema.of(data.columns)
+    for c in schema.columns[~schema.parsed]:
+        print(f"Can not parse {c}")
+    schema = MetricSchema(schema.columns[schema.parsed])
+
+    n_services = len(schema.services)
+    n_metrics = len(schema.metrics)
 
     fig, axs = plt.subplots(n_services, n_metrics, figsize=figsize)
     fig.tight_layout(pad=3.0)
-    for i, service in enumerate(services):
-        for j, metric in enumerate(metrics):
-            # print(f"{service}_{metric}")
-            try:
-                axs[i, j].plot(data[f"{service}_{metric}"])
-            except Exception:
-                pass
+    for i, service in enumerate(schema.services):
+        for j, metric in enumerate(schema.metrics):
             axs[i, j].set_title(f"{service}_{metric}")
+    for c, i, j in zip(schema.columns, schema.service_codes, schema.metric_codes):
+        axs[i, j].plot(data[c])
 
     if filename is None:
         plt.show()
@@ -153,10 +204,34 @@ def download_data(remote_url=None, local_path=None):
         print("ERROR, something went wrong")
 
 
-def read_data(data_path, strip=True):
-    """Read CSV data for root cause analysis."""
-    data = pd.read_csv(data_path)
+def read_data(data_path, strip=True, cache=False, columns=None):
+    """Read CSV data for root cause analysis.
+
+    With `cache=True`, the preprocessed data is stored once in a float32 Arrow IPC file next
+    to the CSV (rebuilt when the CSV is modified) and memory-mapped by later reads, so that
+    only the requested `columns` and, with `strip`, the rows around the injection time are
+    materialized. This requires pyarrow.
+    """
     data_dir = os.path.dirname(data_path)
+    inject_time = None
+    if strip is True and exists(join(data_dir, "inject_time.txt")):
+        with open(join(data_dir, "inject_time.txt")) as f:
+            inject_time = int(f.readlines()[0].strip())
+
+    if cache is True:
+        return _read_arrow_cache(data_path, columns=columns, inject_time=inject_time)
+
+    data = _read_csv(data_path)
+    if columns is not None:
+        data = data[["time"] + [c for c in columns if c != "time"]]
+    if inject_time is not None:
+        data = data.iloc[_strip_rows(data["time"].to_numpy(), inject_time)].reset_index(drop=True)
+    return data
+
+
+def _read_csv(data_path):
+    """Read and preprocess the whole CSV data."""
+    data = pd.read_csv(data_path)
 
     ############# PREPROCESSING ###############
     if "time.1" in data:
@@ -175,38 +250,74 @@ def read_data(data_path, strip=True):
             if c.endswith("_latency-90")
         }
     )
-
-    if strip is True and exists(join(data_dir, "inject_time.txt")):
-        # cut the data into 10 mins
-        data_length = 300
-        with open(join(data_dir, "inject_time.txt")) as f:
-            inject_time = int(f.readlines()[0].strip())
-        normal_df = data[data["time"] < inject_time].tail(data_length)
-        anomal_df = data[data["time"] >= inject_time].head(data_length)
-        data = pd.concat([normal_df, anomal_df], ignore_index=True)    
     return data
 
+
+def _strip_rows(time, inject_time, data_length=300):
+    """The rows of the 10 mins around the injection time: `data_length` before and after it."""
+    normal = np.flatnonzero(time < inject_time)[-data_length:]
+    anomal = np.flatnonzero(time >= inject_time)[:data_length]
+    return np.concatenate([normal, anomal])
+
+
+def _read_arrow_cache(data_path, columns=None, inject_time=None):
+    """Read the preprocessed data from its Arrow IPC cache, building it if missing or stale."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("read_data(cache=True) requires pyarrow, install it with `pip install pyarrow`")
+
+    cache_path = data_path + ".arrow"
+    stat = os.stat(data_path)
+    source = f"{stat.st_mtime_ns}:{stat.st_size}".encode()
+
+    table = None
+    if exists(cache_path):
+        table = pa.ipc.open_file(pa.memory_map(cache_path)).read_all()
+        if (table.schema.metadata or {}).get(b"baro_source") != source:
+            table = None
+    if table is None:
+        data = _read_csv(data_path)
+        values = [c for c in data.select_dtypes("number").columns if c != "time"]
+        table = pa.Table.from_pandas(data.astype({c: np.float32 for c in values}), preserve_index=False)
+        table = table.replace_schema_metadata({b"baro_source": source})
+        # write to a file of our own then rename it, so that concurrent writers do not
+        # share a file and readers never see a partial one
+        fd, tmp_path = tempfile.mkstemp(
+            dir=dirname(cache_path) or ".", prefix=basename(cache_path) + ".", suffix=".tmp"
+        )
+        os.close(fd)
+        try:
+            with pa.OSFile(tmp_path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        table = pa.ipc.open_file(pa.memory_map(cache_path)).read_all()
+
+    if columns is not None:
+        table = table.select(["time"] + [c for c in columns if c != "time"])
+    if inject_time is not None:
+        table = table.take(_strip_rows(table.column("time").to_numpy(), inject_time))
+    return table.to_pandas()
+
 def to_service_ranks(ranks):
     """Convert fine-grained ranking to service ranks."""
-    _service_ranks = [r.split("_")[0] for r in ranks]
-    service_ranks = []
-    # remove duplicates
-    for s in _service_ranks:
-        if s not in service_ranks:
-            service_ranks.append(s)
-    return service_ranks
+    # the services are factorized in order of first appearance
+    return MetricSchema(ranks).services.tolist()
 
 
 def select_latency_and_error(data):
     """Select latency and error columns, retain `time` col"""
-    latency_cols = [c for c in data.columns if "latency" in c]
-    error_cols = [c for c in data.columns if "error" in c]
-    return data[["time"] + latency_cols + error_cols]    
+    schema = MetricSchema.of(data.columns)
+    latency_cols = data.columns[schema.contains("latency")].to_list()
+    error_cols = data.columns[schema.contains("error")].to_list()
+    return data[["time"] + latency_cols + error_cols]
 
 def find_cps(maxes):
-    """Find change points given a `maxes` array."""
-    cps = []
-    for i in range(1, len(maxes)):
-        if abs(maxes[i] - maxes[i-1]) > 1:
-            cps.append((i, abs(maxes[i] - maxes[i-1])))
-    return cps
\ No newline at end of file
+    """Find change points given a `maxes` array, i.e. the jumps of the run length larger than 1."""
+    jumps = np.abs(np.diff(np.asarray(maxes)))
+    idx = np.flatnonzero(jumps > 1)
+    return list(zip((idx + 1).tolist(), jumps[idx].tolist()))
\ No newline at end of file
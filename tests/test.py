@@ -7,13 +7,23 @@ import numpy as np
 import pandas as pd
 import pytest
 import tempfile
+import warnings
 
-from baro.anomaly_detection import nsigma, bocpd
+from baro.anomaly_detection import (
+    nsigma,
+    bocpd,
+    bocpd_hazard_sweep,
+    reduce_dimensions,
+    find_anomalies,
+    univariate_bocpd,
+)
 from baro.root_cause_analysis import robust_scorer
 from baro.utility import (
     visualize_metrics,
     download_data,
     drop_constant,
+    find_cps,
+    read_data,
     download_online_boutique_dataset,
     download_sock_shop_dataset,
     download_train_ticket_dataset,
@@ -51,7 +61,39 @@ def test_nsigma_basic():
     anomalies = nsigma(df, startsfrom=300)
     assert abs(anomalies[0] - 500) < 10, anomalies
 
+    # the expanding-window rule, column by column
+    df["error"] = np.random.normal(0, 1, 1000)
+    df.loc[10, "error"] = np.nan
+    expected = []
+    for col in ["latency", "error"]:
+        for i in range(5, len(df)):
+            mean = df[col].iloc[:i].mean()
+            std = df[col].iloc[:i].std()
+            if abs(df[col].iloc[i] - mean) > 3 * std:
+                expected.append(df['time'].iloc[i])
+    anomalies, mask = nsigma(df, startsfrom=5, return_mask=True)
+    assert anomalies == expected
+    assert mask["latency"].sum() + mask["error"].sum() == len(expected)
+
      
+def test_find_anomalies():
+    """Test thresholding and merging of detector outputs."""
+    maxes = np.array([0, 1, 2, 3, 0, 1, 2, 5, 6, 7, 0])
+    assert find_cps(maxes) == [(4, 3.0), (7, 3.0), (10, 7.0)]
+    assert find_cps(maxes.tolist()) == find_cps(maxes)
+
+    time_col = pd.Series(np.arange(100, 120))
+    scores = np.zeros(20)
+    scores[[0, 3, 4, 6, 12, 19]] = 1
+    merged, anomalies = find_anomalies(scores, time_col=time_col)
+    assert anomalies == [103, 104, 106, 112, 119]
+    assert merged == [103, 112, 119]
+
+    scores = np.zeros(20)
+    scores[8] = 0.001
+    assert find_anomalies(scores, time_col=time_col) == ([108], [108])
+
+
 def test_bocpd_basic():
     """Test bocpd basic."""
     time_col = np.arange(0, 200, 1)
@@ -89,4 +131,720 @@ def test_baro():
     # check if cartservice is in the top 5
     service_ranks = [r.split("_")[0] for r in ranks]
     assert "cartservice" in service_ranks[:5]
-    
\ No newline at end of file
+    
+
+def test_truncated_bocpd():
+    """Test the log-space truncated BOCPD engine."""
+    from functools import partial
+    from baro._bocpd import (
+        online_changepoint_detection,
+        truncated_online_changepoint_detection,
+        constant_hazard,
+        MultivariateT,
+    )
+    data = np.concatenate([np.random.normal(0, 0.1, (60, 2)), np.random.normal(1, 0.1, (60, 2))])
+
+    # without truncation, the log-space engine reproduces the dense one
+    R, maxes = online_changepoint_detection(data, partial(constant_hazard, 50), MultivariateT(dims=2))
+    cp_probs, log_maxes = truncated_online_changepoint_detection(
+        data, partial(constant_hazard, 50), MultivariateT(dims=2), prune_threshold=0
+    )
+    assert np.array_equal(maxes, log_maxes)
+    assert np.allclose(cp_probs[:-1], R[10, :-1])
+
+    # with truncation, the changepoint is still found
+    _, maxes = truncated_online_changepoint_detection(
+        data, partial(constant_hazard, 50), MultivariateT(dims=2), max_run_length=20
+    )
+    assert abs(find_cps(maxes)[0][0] - 60) < 10
+
+    time_col = np.arange(0, 200, 1)
+    latency = np.concatenate((np.random.normal(3, 1, 100), np.random.normal(50, 1, 100)))
+    df = pd.DataFrame({'time': time_col, 'latency': latency})
+    anomalies = bocpd(df, max_run_length=50)
+    assert abs(anomalies[0] - 100) < 10, anomalies
+
+
+def test_truncated_bocpd_multivariate():
+    """Test the capped engine against the dense one on a gradual multivariate shift."""
+    from functools import partial
+    from baro._bocpd import (
+        online_changepoint_detection,
+        truncated_online_changepoint_detection,
+        constant_hazard,
+        MultivariateT,
+    )
+    from baro.anomaly_detection import _prepare
+    rng = np.random.default_rng(0)
+    values = rng.normal(0, 1, (400, 20))
+    values[200:, :5] += 2
+    df = pd.DataFrame(values, columns=[f"service{i}_latency" for i in range(20)])
+    df.insert(0, "time", np.arange(400))
+    data, _ = _prepare(df)
+
+    _, dense = online_changepoint_detection(data, partial(constant_hazard, 50), MultivariateT(dims=20))
+    cps = find_cps(dense)
+    assert 200 <= cps[0][0] < 400, cps
+
+    # a cap that is never reached changes nothing
+    _, maxes = truncated_online_changepoint_detection(
+        data, partial(constant_hazard, 50), MultivariateT(dims=20), max_run_length=400
+    )
+    assert np.array_equal(maxes, dense)
+    # the hypotheses of the new run survive a cap while the evidence builds up
+    _, maxes = truncated_online_changepoint_detection(
+        data, partial(constant_hazard, 50), MultivariateT(dims=20), max_run_length=50
+    )
+    assert find_cps(maxes)[0] == cps[0]
+    assert bocpd(df, max_run_length=50)[0] == cps[0][0]
+
+
+def test_multivariate_t_logpdf():
+    """Test the batched log density against scipy."""
+    import scipy.stats as ss
+    from baro._bocpd import MultivariateT
+    model = MultivariateT(dims=3)
+    data = np.random.normal(0, 1, (20, 3))
+    for t, x in enumerate(data):
+        model.pdf(x)
+        model.update_theta(x, t=t)
+
+    x = np.random.normal(0, 1, 3)
+    t_dof = model.dof - model.dims + 1
+    expanded = np.expand_dims((model.kappa * t_dof) / (model.kappa + 1), (1, 2))
+    expected = [
+        ss.multivariate_t.logpdf(x, df=df, loc=loc, shape=shape)
+        for df, loc, shape in zip(t_dof, model.mu, np.linalg.inv(expanded * model.scale))
+    ]
+    assert np.allclose(model.logpdf(x), expected)
+
+
+def test_multivariate_t_rank_one_update():
+    """Test the Cholesky rank-one updates against the double inversion."""
+    from baro._bocpd import MultivariateT
+    model = MultivariateT(dims=4)
+    scale = np.array([np.identity(4)])
+    mu = np.zeros((1, 4))
+    kappa = np.array([1])
+    data = np.random.normal(0, 1, (30, 4))
+    for t, x in enumerate(data):
+        model.update_theta(x, t=t)
+
+        # the previous implementation
+        centered = x - mu
+        scale = np.concatenate([scale[:1], np.linalg.inv(
+            np.linalg.inv(scale)
+            + np.expand_dims(kappa / (kappa + 1), (1, 2))
+            * (np.expand_dims(centered, 2) @ np.expand_dims(centered, 1))
+        )])
+        mu = np.concatenate([mu[:1], (np.expand_dims(kappa, 1) * mu + x) / np.expand_dims(kappa + 1, 1)])
+        kappa = np.concatenate([kappa[:1], kappa + 1])
+    assert np.allclose(model.scale, scale)
+    assert np.allclose(model.mu, mu)
+
+
+def test_multivariate_t_buffers():
+    """Test the preallocated parameter buffers grow and prune in place."""
+    from baro._bocpd import MultivariateT
+    small, large = MultivariateT(dims=2, capacity=1), MultivariateT(dims=2, capacity=50)
+    for t, x in enumerate(np.random.normal(0, 1, (20, 2))):
+        small.update_theta(x, t=t)
+        large.update_theta(x, t=t)
+    assert large.params.capacity == 50
+    assert len(small.dof) == len(large.dof) == 21
+    assert np.allclose(small.scale, large.scale)
+
+    keep = np.array([0, 3, 7])
+    expected = large.mu[keep]
+    large.prune(keep)
+    assert np.array_equal(large.mu, expected)
+    assert np.array_equal(large.kappa, [1, 4, 8])
+
+
+def test_streaming_bocpd():
+    """Test the streaming BOCPD against the batch engine."""
+    from functools import partial
+    from baro._bocpd import (
+        StreamingBOCPD,
+        truncated_online_changepoint_detection,
+        constant_hazard,
+        MultivariateT,
+    )
+    data = np.concatenate([np.random.normal(0, 0.1, (60, 2)), np.random.normal(1, 0.1, (60, 2))])
+    _, maxes = truncated_online_changepoint_detection(
+        data, partial(constant_hazard, 50), MultivariateT(dims=2), max_run_length=30
+    )
+
+    detector = StreamingBOCPD(partial(constant_hazard, 50), MultivariateT(dims=2), max_run_length=30)
+    map_run_length, cp_prob = detector.step(data[0])
+    batch_maxes, cp_probs = detector.update(data[1:])
+    assert map_run_length == maxes[1]
+    assert np.array_equal(batch_maxes[:-1], maxes[2:-1])
+    assert len(detector.run_lengths) <= 30
+    assert len(detector.log_likelihood_class.dof) == len(detector.run_lengths)
+
+
+def test_diagonal_t():
+    """Test the independent-dimension likelihood."""
+    from baro._bocpd import DiagonalT, MultivariateT
+    diagonal, multivariate = DiagonalT(dims=1), MultivariateT(dims=1)
+    for t, x in enumerate(np.random.normal(0, 1, (20, 1))):
+        assert np.allclose(diagonal.logpdf(x), multivariate.logpdf(x))
+        diagonal.update_theta(x, t=t)
+        multivariate.update_theta(x, t=t)
+
+    time_col = np.arange(0, 200, 1)
+    df = pd.DataFrame({'time': time_col})
+    for i in range(20):
+        df[f"service{i}_latency"] = np.concatenate(
+            (np.random.normal(3, 1, 100), np.random.normal(3 + 5 * (i % 2), 1, 100))
+        )
+    anomalies = bocpd(df, likelihood="diagonal")
+    assert abs(anomalies[0] - 100) < 10, anomalies
+
+
+def test_bocpd_hazard_sweep():
+    """Test the hazard sweep against one bocpd run per hazard."""
+    from functools import partial
+    from baro._bocpd import online_changepoint_detection, hazard_sweep, constant_hazard, MultivariateT
+    data = np.concatenate([np.random.normal(0, 0.1, (60, 2)), np.random.normal(1, 0.1, (60, 2))])
+    lams = [10, 50, 250]
+    maxes = hazard_sweep(data, [partial(constant_hazard, lam) for lam in lams], MultivariateT(dims=2))
+    for lam, m in zip(lams, maxes):
+        _, expected = online_changepoint_detection(data, partial(constant_hazard, lam), MultivariateT(dims=2))
+        assert np.array_equal(m, expected)
+
+    time_col = np.arange(0, 200, 1)
+    latency = np.concatenate((np.random.normal(3, 1, 100), np.random.normal(50, 1, 100)))
+    df = pd.DataFrame({'time': time_col, 'latency': latency})
+    anomalies = bocpd_hazard_sweep(df, lams=(50, 100))
+    assert anomalies[50] == bocpd(df)
+    assert abs(anomalies[100][0] - 100) < 10, anomalies
+
+
+def test_bocpd_reduce_dimensions():
+    """Test bocpd on projected metrics."""
+    time_col = np.arange(0, 200, 1)
+    df = pd.DataFrame({'time': time_col})
+    for i in range(40):
+        df[f"service{i}_latency"] = np.concatenate(
+            (np.random.normal(3, 1, 100), np.random.normal(3 + 5 * (i % 2), 1, 100))
+        )
+    projected, explained_variance_ratio = reduce_dimensions(df, n_components=3)
+    assert projected.shape == (200, 3)
+    assert explained_variance_ratio[0] > 0.5
+    assert projected.min() == 0 and projected.max() == 1
+
+    for reduction in ["pca", "random"]:
+        anomalies = bocpd(df, n_components=3, reduction=reduction)
+        assert abs(anomalies[0] - 100) < 10, anomalies
+
+
+def test_streaming_bocpd_checkpoint():
+    """Test saving and resuming the streaming BOCPD."""
+    from functools import partial
+    from baro._bocpd import StreamingBOCPD, constant_hazard, MultivariateT, DiagonalT
+    data = np.concatenate([np.random.normal(0, 0.1, (60, 2)), np.random.normal(1, 0.1, (60, 2))])
+    path = tempfile.NamedTemporaryFile(suffix=".npz").name
+    for likelihood_class in [MultivariateT, DiagonalT]:
+        detector = StreamingBOCPD(partial(constant_hazard, 50), likelihood_class(dims=2), max_run_length=30)
+        detector.update(data[:50])
+        detector.save(path)
+        expected = detector.update(data[50:])
+
+        resumed = StreamingBOCPD.load(path, partial(constant_hazard, 50))
+        assert resumed.t == 50 and resumed.max_run_length == 30
+        assert isinstance(resumed.log_likelihood_class, likelihood_class)
+        maxes, cp_probs = resumed.update(data[50:])
+        assert np.array_equal(maxes, expected[0])
+        assert np.allclose(cp_probs, expected[1])
+    os.remove(path)
+
+
+def test_bocpd_float32(monkeypatch):
+    """Test the float32 BOCPD against float64."""
+    from functools import partial
+    from baro._bocpd import StreamingBOCPD, constant_hazard, MultivariateT, DiagonalT
+    data = np.concatenate([np.random.normal(0, 0.1, (60, 3)), np.random.normal(1, 0.1, (60, 3))])
+    for likelihood_class in [MultivariateT, DiagonalT]:
+        detector = StreamingBOCPD(partial(constant_hazard, 50), likelihood_class(dims=3, dtype=np.float32))
+        maxes32, _ = detector.update(data)
+        assert detector.log_R.dtype == np.float32
+        assert detector.log_likelihood_class.mu.dtype == np.float32
+        detector = StreamingBOCPD(partial(constant_hazard, 50), likelihood_class(dims=3))
+        maxes64, _ = detector.update(data)
+        assert np.array_equal(maxes32, maxes64)
+
+    time_col = np.arange(0, 200, 1)
+    df = pd.DataFrame({'time': time_col})
+    for i in range(5):
+        df[f"service{i}_latency"] = np.concatenate((np.random.normal(3, 1, 100), np.random.normal(3 + 5 * (i % 2), 1, 100)))
+    assert bocpd(df, dtype=np.float32)[0] == bocpd(df)[0]
+
+    # float32 does not prune the run lengths, with or without a cap
+    from baro import _bocpd
+    truncated, calls = _bocpd.truncated_online_changepoint_detection, []
+
+    def spy(*args, **kwargs):
+        calls.append(kwargs)
+        return truncated(*args, **kwargs)
+
+    monkeypatch.setattr(_bocpd, "truncated_online_changepoint_detection", spy)
+    bocpd(df, dtype=np.float32)
+    bocpd(df, dtype=np.float32, max_run_length=50)
+    assert len(calls) == 2 and all(c.get("prune_threshold", 0) == 0 for c in calls)
+
+
+def test_univariate_bocpd():
+    """Test the per-column univariate BOCPD and its fusion."""
+    time_col = np.arange(0, 200, 1)
+    df = pd.DataFrame({'time': time_col})
+    for i in range(4):
+        df[f"service{i}_latency"] = np.random.normal(3, 1, 200)
+    df["service1_latency"] += np.concatenate((np.zeros(100), np.full(100, 20)))
+    df["service3_latency"] += np.concatenate((np.zeros(100), np.full(100, 20)))
+
+    output = univariate_bocpd(df, n_jobs=2)
+    assert abs(output["anomalies"][0] - 100) < 10, output
+    assert output["columns"][0] == ["service1_latency", "service3_latency"]
+    assert len(output["scores"]) == len(df)
+
+    output = univariate_bocpd(df, n_jobs=1, fusion="count", min_columns=2)
+    assert abs(output["anomalies"][0] - 100) < 10, output
+    assert bocpd(df, univariate=True, n_jobs=1)[0] == univariate_bocpd(df, n_jobs=1)["anomalies"][0]
+    for option in [{"likelihood": "diagonal"}, {"dtype": np.float32}, {"early_exit": True}, {"coarse_factor": 4}]:
+        with pytest.raises(AssertionError):
+            bocpd(df, univariate=True, n_jobs=1, **option)
+
+
+def test_bocpd_prepare():
+    """Test the vectorized bocpd preprocessing against the pandas one."""
+    from baro.anomaly_detection import _prepare
+    df = pd.DataFrame({
+        "time": np.arange(50),
+        "a_latency": np.random.normal(3, 1, 50),
+        "b_latency-50": np.random.randint(0, 10, 50),
+        "c_error": np.full(50, 2.0),
+        "d_error": np.full(50, np.nan),
+        "e_latency": np.random.normal(3, 1, 50),
+        "queue-master_latency": np.random.normal(3, 1, 50),
+        "f_cpu": np.random.normal(3, 1, 50),
+    })
+    df.loc[[0, 5, 6, 30], "a_latency"] = np.nan
+    df.loc[10, "e_latency"] = np.inf
+    df.loc[3, "d_error"] = 1.0
+
+    # the previous implementation
+    expected = df[[c for c in df.columns if ("latency" in c or "_error" in c) and "queue-master" not in c]]
+    expected = drop_constant(expected).ffill().fillna(0)
+    for c in expected.columns:
+        expected[c] = (expected[c] - np.min(expected[c])) / (np.max(expected[c]) - np.min(expected[c]))
+    expected = expected.ffill().fillna(0)
+
+    values, columns = _prepare(df)
+    assert columns == expected.columns.to_list()
+    assert np.array_equal(values, expected.to_numpy())
+
+
+def test_robust_scorer():
+    """Test RobustScorer and nsigma rankings against the sklearn scalers."""
+    from sklearn.preprocessing import RobustScaler, StandardScaler
+    from baro.root_cause_analysis import nsigma as nsigma_scorer
+    df = pd.DataFrame({"time": np.arange(200)})
+    for i in range(30):
+        df[f"service{i}_latency"] = np.random.normal(3, 1 + i % 3, 200)
+        df.loc[100:, f"service{i}_latency"] += np.random.uniform(0, 10)
+    df["constant_mem"] = 5.0
+    df["spiky_cpu"] = 1.0
+    df.loc[[10, 150], "spiky_cpu"] = [2.0, 4.0]
+
+    for scorer, scaler in [(robust_scorer, RobustScaler), (nsigma_scorer, StandardScaler)]:
+        output = scorer(df, inject_time=100)
+        expected = []
+        for col in output["node_names"]:
+            scores = scaler().fit(df[col][:100].to_numpy().reshape(-1, 1)).transform(
+                df[col][100:].to_numpy().reshape(-1, 1)
+            )[:, 0]
+            expected.append((col, max(scores)))
+        expected = [x[0] for x in sorted(expected, key=lambda x: x[1], reverse=True)]
+        assert output["ranks"] == expected
+
+
+def test_baseline_store():
+    """Test scoring with a stored baseline of the normal period."""
+    from baro.baseline import Baseline, BaselineStore
+    df = pd.DataFrame({"time": np.arange(200)})
+    for i in range(10):
+        df[f"service{i}_latency"] = np.random.normal(3, 1, 200)
+        df.loc[100:, f"service{i}_latency"] += i
+    expected = robust_scorer(df, inject_time=100)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = BaselineStore(path.join(tmp, "baselines.db"), max_entries=2)
+        store.put("case", 0, 100, Baseline.from_frame(df[df["time"] < 100]))
+        store.close()
+
+        # reopened from disk, the normal period is no longer needed
+        store = BaselineStore(path.join(tmp, "baselines.db"), max_entries=2)
+        baseline = store.get("case", 0, 100)
+        output = robust_scorer(df[df["time"] >= 100], inject_time=100, baseline=baseline)
+        assert output == expected
+        assert store.get("case", 0, 50) is None
+        assert store.get("case", 0, 100, columns=["service1_latency"]).columns == ["service1_latency"]
+
+        # least recently used eviction
+        store.put("other", 0, 100, baseline)
+        store.get("case", 0, 100)
+        store.put("third", 0, 100, baseline)
+        assert len(store) == 2 and store.get("other", 0, 100) is None
+        store.close()
+
+    store = BaselineStore(ttl=0)
+    store.put("case", 0, 100, baseline)
+    assert store.get("case", 0, 100) is None
+
+
+def test_sliding_robust_stats():
+    """Test the sliding baseline against the one computed from the window."""
+    from baro.baseline import Baseline, SlidingRobustStats
+    df = pd.DataFrame({"time": np.arange(300)})
+    for i in range(5):
+        df[f"service{i}_cpu"] = np.random.normal(3, 1, 300).round(1)
+    df["service0_mem"] = np.random.normal(5e8, 1e7, 300)
+    df["constant_cpu"] = 1.0
+    df.loc[::7, "service1_cpu"] = np.nan
+
+    stats = SlidingRobustStats(df.columns, window=50)
+    stats.update(df.to_numpy()[:30])
+    for end in range(31, 300):
+        stats.update(df.to_numpy()[end - 1])
+        if end % 41 == 0:
+            window = df.iloc[max(end - 50, 0) : end]
+            expected = Baseline.from_frame(window)
+            baseline = stats.baseline()
+            assert baseline.columns == expected.columns
+            for name in ["median", "iqr", "mean", "std"]:
+                assert np.allclose(getattr(baseline, name), getattr(expected, name))
+
+    stats.update(df.to_numpy())
+    assert np.allclose(stats.percentile(50), np.nanpercentile(df.to_numpy()[-50:], 50, axis=0))
+    output = robust_scorer(df[df["time"] >= 250], inject_time=250, baseline=stats.baseline())
+    assert set(output["ranks"]) == set(stats.baseline().columns)
+
+    # large values with a small spread, e.g. byte counters
+    values = 2e9 + np.random.normal(0, 10, (500, 2))
+    values[::9, 1] = np.nan
+    stats = SlidingRobustStats(["service0_bytes", "service1_bytes"], window=100)
+    for row in values:
+        stats.update(row)
+    assert np.allclose(stats.baseline().mean, np.nanmean(values[-100:], axis=0))
+    assert np.allclose(stats.baseline().std, np.nanstd(values[-100:], axis=0))
+
+
+def test_robust_scorer_batch():
+    """Test batch RobustScorer on cases with different columns and lengths."""
+    from baro.root_cause_analysis import robust_scorer_batch
+    datas, anomalies = [], []
+    for case in range(4):
+        length = 150 + 20 * case
+        df = pd.DataFrame({"time": np.arange(length)})
+        for i in range(case, case + 8):
+            df[f"service{i}_latency"] = np.random.normal(3, 1, length)
+            df.loc[100:, f"service{i}_latency"] += np.random.uniform(0, 5)
+        df["service0_cpu"] = np.random.randint(0, 3, length).astype(float)
+        # missing samples, in both periods, and a column missing from the anomalous one
+        df.loc[[20, 110, 140], f"service{case + 1}_latency"] = np.nan
+        df.loc[100 - case :, f"service{case + 2}_latency"] = np.nan
+        df = df[["time"] + list(np.random.permutation(df.columns[1:]))]
+        datas.append(df)
+        anomalies.append([100 - case])
+
+    outputs = robust_scorer_batch(datas, anomalies=anomalies)
+    for data, anomaly, output in zip(datas, anomalies, outputs):
+        assert output == robust_scorer(data, anomalies=anomaly)
+    outputs = robust_scorer_batch(datas, inject_times=[100] * 4)
+    assert outputs[3] == robust_scorer(datas[3], inject_time=100)
+
+    # columns selected several times by preprocess
+    datas[0]["runtime_cpu"] = np.random.normal(10, 3, len(datas[0]))
+    outputs = robust_scorer_batch(datas, inject_times=[100] * 4, dk_select_useful=True)
+    assert outputs[0] == robust_scorer(datas[0], inject_time=100, dk_select_useful=True)
+
+    # the percentiles of the NaN-padded stack
+    from baro.baseline import _nanpercentile
+    values = np.random.normal(0, 1, (3, 40, 5)).round(1)
+    values[np.random.uniform(size=values.shape) < 0.3] = np.nan
+    values[:, 25:, 1] = np.nan
+    values[0, :, 2] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = np.nanpercentile(values, [25, 50, 75], axis=1)
+    assert np.array_equal(_nanpercentile(values, [25, 50, 75], axis=1), expected, equal_nan=True)
+
+
+def test_preprocess_profile():
+    """Test that the single-pass preprocess selects like the chained steps."""
+    from baro.root_cause_analysis import (
+        preprocess, convert_mem_mb, drop_extra, select_useful_cols
+    )
+    from baro.utility import drop_time, drop_constant, drop_near_constant
+    n = 200
+    df = pd.DataFrame({"time": np.arange(n), "time.1": np.arange(n)})
+    df["carts_cpu"] = np.random.normal(5, 2, n)
+    df["carts_mem"] = np.random.normal(5e8, 5e6, n)
+    df["small_mem"] = np.random.normal(5e8, 1e5, n)
+    df["carts_lat50"] = np.random.normal(0.1, 0.05, n)
+    df["flat_lat50"] = np.random.normal(0.1, 0.001, n)
+    df["redis_cpu"] = np.random.normal(5, 2, n)
+    df["frontend-external_lat50"] = np.random.normal(0.1, 0.05, n)
+    df["runtime_cpu"] = np.random.normal(5, 2, n)
+    df["constant_cpu"] = 3
+    df["rare_cpu"] = 3.0
+    df.loc[[5, 50], "rare_cpu"] = 100.0
+    df["orders_cpu"] = np.random.randint(0, 10, n)
+    df.loc[7, "carts_cpu"] = np.nan
+    df["host"] = "node-1"
+    df["pod"] = np.where(np.arange(n) < 150, "carts-a", "carts-b")
+    df["time_zone"] = "UTC"
+    df.loc[:49, "time_zone"] = "CET"
+
+    for dk_select_useful in [False, True]:
+        expected = convert_mem_mb(drop_constant(drop_time(df)))
+        if dk_select_useful:
+            expected = drop_near_constant(drop_extra(expected))
+            expected = expected[select_useful_cols(expected)]
+        output = preprocess(df, dk_select_useful=dk_select_useful)
+        pd.testing.assert_frame_equal(output, expected, check_dtype=False)
+    assert "pod" in preprocess(df) and "host" not in preprocess(df)
+    assert "time_zone" in preprocess(df, dk_select_useful=True)
+    df = pd.DataFrame({"time": np.arange(5), "a_cpu": np.arange(5.0), "host": "node-1"})
+    assert preprocess(df).columns.tolist() == ["a_cpu"]
+
+
+def test_metric_schema():
+    """Test the metric schema and the helpers using it."""
+    from baro.utility import MetricSchema, select_latency_and_error, to_service_ranks
+    columns = ["time", "carts_cpu", "carts_latency", "orders_cpu", "carts_mem", "orders_error", "db_latency_50"]
+    schema = MetricSchema(columns)
+    assert schema.services.tolist() == ["time", "carts", "orders", "db"]
+    assert schema.metrics.tolist() == ["cpu", "latency", "mem", "error", "latency_50"]
+    assert schema.parsed.tolist() == [False] + [True] * 6
+    assert [g.tolist() for g in schema.groups()] == [[0], [1, 2, 4], [3, 5], [6]]
+    assert [g.tolist() for g in schema.groups("metric")][0] == [1, 3]
+    assert schema.contains("latency", "error").tolist() == [False, False, True, False, False, True, True]
+    assert MetricSchema.of(columns) is MetricSchema.of(list(columns))
+
+    assert to_service_ranks(["b_cpu", "a_mem", "b_latency", "c", "a_cpu"]) == ["b", "a", "c"]
+    df = pd.DataFrame(np.zeros((2, len(columns))), columns=columns)
+    assert select_latency_and_error(df).columns.tolist() == [
+        "time", "carts_latency", "db_latency_50", "orders_error"
+    ]
+
+
+def test_read_data_cache():
+    """Test reading the data through its Arrow IPC cache."""
+    pytest.importorskip("pyarrow")
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = path.join(tmp, "simple_data.csv")
+        df = pd.DataFrame({"time": np.arange(1000, 2000)})
+        df["carts_cpu"] = np.random.rand(1000)
+        df["carts_latency-90"] = np.random.rand(1000)
+        df["carts_latency-50"] = np.random.rand(1000)
+        df.loc[5, "carts_cpu"] = np.inf
+        df.to_csv(data_path, index=False)
+        with open(path.join(tmp, "inject_time.txt"), "w") as f:
+            f.write("1500\n")
+
+        expected = read_data(data_path)
+        assert len(expected) == 600
+        for _ in range(2):
+            output = read_data(data_path, cache=True)
+            assert path.exists(data_path + ".arrow")
+            assert output["carts_cpu"].dtype == np.float32
+            pd.testing.assert_frame_equal(output, expected, check_dtype=False, rtol=1e-6)
+
+        output = read_data(data_path, cache=True, strip=False, columns=["carts_latency"])
+        assert output.columns.tolist() == ["time", "carts_latency"] and len(output) == 1000
+
+        # a modified CSV invalidates the cache
+        df.head(800).to_csv(data_path, index=False)
+        assert len(read_data(data_path, cache=True, strip=False)) == 800
+
+        # concurrent writers of the same cache each use their own temporary file
+        other_writer = data_path + ".arrow.tmp"
+        with open(other_writer, "wb") as f:
+            f.write(b"partial")
+        df.head(900).to_csv(data_path, index=False)
+        assert len(read_data(data_path, cache=True, strip=False)) == 900
+        with open(other_writer, "rb") as f:
+            assert f.read() == b"partial"
+        assert sorted(os.listdir(tmp)) == [
+            "inject_time.txt", "simple_data.csv", "simple_data.csv.arrow", "simple_data.csv.arrow.tmp"
+        ]
+
+
+def test_metric_store():
+    """Test memory-mapped window reads of a metric store."""
+    from baro.storage import MetricStore
+    df = pd.DataFrame({"time": np.random.permutation(np.arange(2000, 4000))})
+    for i in range(5):
+        df[f"service{i}_cpu"] = np.random.rand(2000)
+    expected = df.sort_values("time").reset_index(drop=True)
+    expected[expected.columns[1:]] = expected[expected.columns[1:]].astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = MetricStore.write(path.join(tmp, "store"), df)
+        store = MetricStore(path.join(tmp, "store"))
+        assert len(store) == 2000 and store.columns == df.columns[1:].tolist()
+
+        output = store.window(2500, 2600)
+        window = expected[(expected.time >= 2500) & (expected.time < 2600)]
+        pd.testing.assert_frame_equal(output, window.reset_index(drop=True))
+        assert np.shares_memory(output["service0_cpu"].to_numpy(), store.values)
+        output = store.window(3990, columns=["service3_cpu", "service1_cpu"])
+        assert output.columns.tolist() == ["time", "service3_cpu", "service1_cpu"] and len(output) == 10
+
+        output = store.around(2100)
+        assert output["time"].tolist() == list(range(2000, 2400))
+        output = store.around(3000)
+        assert len(output) == 600 and output["time"].iloc[300] == 3000
+        assert isinstance(bocpd(output), list)
+        assert len(robust_scorer(output, inject_time=3000)["ranks"]) == 5
+
+
+def test_bucket_percentages():
+    """Test the vectorized histogram percentiles against the per-row ones."""
+    from baro.metric import (
+        parse_bucket_counts, bucket_percentages, weighted_sums, process_bucket_counts,
+        calculate_weighted_sum, normalize_bucket_counts
+    )
+    rows = [str(np.random.randint(0, 5, 15).tolist()) for _ in range(200)]
+    rows += ["[0, 0, 0, 0]", "[3, 0, 0, 1, 0, 0]", "[]", "[7]"]
+    df = pd.DataFrame({"BucketCounts": rows, "Count": np.random.randint(1, 10, len(rows))})
+    df = normalize_bucket_counts(df)
+    counts, lengths = parse_bucket_counts(df["BucketCounts"])
+    assert lengths.tolist()[-4:] == [4, 6, 0, 1]
+
+    weights = [0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 7.5, 10, 10]
+    for percentage in [0.10, 0.05, 0.01]:
+        output = bucket_percentages(counts, percentage)
+        for row, n, expected in zip(output, lengths, df["BucketCounts"]):
+            assert row[:n].tolist() == process_bucket_counts(expected, percentage)
+            assert not row[n:].any()
+        latency = [str(row[:n].tolist()) for row, n in zip(output, lengths)]
+        assert np.allclose(
+            weighted_sums(latency, weights), [calculate_weighted_sum(x, weights) for x in latency]
+        )
+
+
+def test_first_changepoint(monkeypatch):
+    """Test the lookahead rule of the early-exit BOCPD on a known MAP trajectory."""
+    from baro import _bocpd
+
+    class ScriptedBOCPD:
+        """Replays a MAP run length trajectory, one value per step."""
+        def __init__(self, hazard_function, log_likelihood_class, **kwargs):
+            self.maps = iter(trajectory)
+            steps.clear()
+
+        def step(self, x):
+            steps.append(x)
+            return next(self.maps), 0.0
+
+    # jumps of the MAP run length at steps 4 (4 -> 1) and 7 (3 -> 1): changepoints 5 and 8
+    trajectory = [1, 2, 3, 4, 1, 2, 3, 1, 2, 3, 4, 5, 6]
+    steps = []
+    monkeypatch.setattr(_bocpd, "StreamingBOCPD", ScriptedBOCPD)
+    data = np.zeros(len(trajectory))
+    assert _bocpd.first_changepoint(data, None, None) == 5
+    assert len(steps) == 5
+    # the candidate holds for 2 steps before the next jump
+    assert _bocpd.first_changepoint(data, None, None, lookahead=2) == 5
+    # the jump at step 7 is inside the lookahead and replaces the candidate
+    assert _bocpd.first_changepoint(data, None, None, lookahead=3) == 8
+    # the data ends before the lookahead: the unconfirmed candidate is returned
+    assert _bocpd.first_changepoint(data, None, None, lookahead=10) == 8
+    trajectory = list(range(1, 14))
+    assert _bocpd.first_changepoint(data, None, None) is None
+
+
+def test_bocpd_early_exit():
+    """Test that early-exit bocpd reports the first change point of the full run."""
+    latency = np.concatenate((np.clip(np.random.normal(3, 1, 100), 1, 5), np.random.normal(50, 1, 100)))
+    df = pd.DataFrame({'time': np.arange(200), 'latency': latency})
+
+    anomalies = bocpd(df)
+    assert bocpd(df, early_exit=True) == anomalies[:1]
+    assert abs(bocpd(df, early_exit=True, lookahead=10)[0] - 100) < 10
+
+
+def test_bocpd_coarse_to_fine():
+    """Test the refinement window and the fallback of coarse-to-fine bocpd."""
+    from baro.anomaly_detection import _coarse_to_fine
+
+    def maxes(n, collapse=None, run=1):
+        """A MAP run length trajectory of n steps, restarting a run of `run` at `collapse`."""
+        maxes = np.arange(n + 1)
+        if collapse is not None:
+            maxes[collapse:] = np.arange(run, run + n + 1 - collapse)
+        return maxes
+
+    data = np.random.rand(400, 2)
+    windows = []
+
+    def detect(x):
+        if len(x) == 100:
+            # the coarse rows: a run starts at coarse row 25, i.e. row 100
+            return maxes(len(x), collapse=26, run=1)
+        windows.append(x)
+        return refine(len(x))
+
+    # the refined run start, 32 rows into the window [70, 130)
+    refine = lambda n: maxes(n, collapse=35, run=3)
+    assert _coarse_to_fine(data, detect, factor=4, window=30) == [102]
+    assert len(windows) == 1 and np.array_equal(windows[0], data[70:130])
+
+    # no change point in the window, or one at its edge: the coarse position is kept
+    for refine in [lambda n: maxes(n), lambda n: maxes(n, collapse=5, run=5)]:
+        assert _coarse_to_fine(data, detect, factor=4, window=30) == [100]
+
+    # a window clipped at the end of the data
+    windows.clear()
+    refine = lambda n: maxes(n)
+    assert _coarse_to_fine(data, detect, factor=4, window=500) == [100]
+    assert np.array_equal(windows[0], data)
+
+    latency = np.concatenate((np.clip(np.random.normal(3, 1, 100), 1, 5), np.random.normal(50, 1, 100)))
+    df = pd.DataFrame({'time': np.arange(200), 'latency': latency})
+    anomalies = bocpd(df, coarse_factor=4)
+    assert abs(anomalies[0] - 100) < 10, anomalies
+
+
+def test_robust_scorer_missing_values():
+    """Test that a missing anomalous sample does not demote a root cause."""
+    from baro.root_cause_analysis import nsigma as nsigma_scorer
+    df = pd.DataFrame({"time": np.arange(200)})
+    for service in ["carts", "orders", "user", "payment"]:
+        df[f"{service}_cpu"] = np.random.normal(10, 1, 200)
+    df.loc[100:, "carts_cpu"] += 50
+    df.loc[150, "carts_cpu"] = np.nan
+    df.loc[120, "user_cpu"] = np.nan
+
+    for scorer in [robust_scorer, nsigma_scorer]:
+        assert scorer(df, inject_time=100)["ranks"][0] == "carts_cpu"
+
+
+def test_robust_scorer_duplicate_columns():
+    """Test scoring the columns preprocess selects several times."""
+    from baro.baseline import Baseline
+    df = pd.DataFrame({"time": np.arange(200)})
+    for col in ["runtime_cpu", "carts_cpu", "orders_cpu"]:
+        df[col] = np.random.normal(10, 3, 200)
+    df.loc[100:, "runtime_cpu"] += 50
+
+    output = robust_scorer(df, inject_time=100, dk_select_useful=True)
+    assert output["node_names"] == ["runtime_cpu", "carts_cpu", "orders_cpu"]
+    assert output["ranks"][0] == "runtime_cpu"
+    baseline = Baseline.from_frame(df[df["time"] < 100], dk_select_useful=True)
+    assert baseline.columns == output["node_names"]
+    assert robust_scorer(df, inject_time=100, dk_select_useful=True, baseline=baseline) == output